@@ -6,12 +6,22 @@ on Ubuntu 10.4 LTS.
 
 from __future__ import with_statement
 from functools import partial
-import os, os.path, time
+import os, os.path, re, sys, time
+import hashlib
+import httplib, socket, urlparse
+import math
+import threading
 import functools
+import json
+import multiprocessing
+import Queue
+import traceback
+from StringIO import StringIO
+from contextlib import contextmanager
 
 from fabric.api import *
 from fabric.contrib.files import append, exists, comment, contains
-from fabric.contrib.files import upload_template as orig_upload_template
+from fabric.network import normalize
 
 # Stuff you're likely to change
 PROJECT_NAME = 'project'
@@ -19,21 +29,98 @@ DOMAIN = 'project.com'
 GIT_CLONE_PATH = 'reverie/%s.git' % PROJECT_NAME
 PRODUCTION_USERNAME = 'root'
 PRODUCTION_HOST = DOMAIN # Change this to an IP if your DNS isn't resolving yet
+PRODUCTION_HOSTS = [PRODUCTION_HOST] # Add more app hosts here for a multi-server setup
+# Which production hosts hold which ROLES. nginx balances over all the django hosts.
+PRODUCTION_TOPOLOGY = {
+    'nginx': [PRODUCTION_HOST],
+    'django': PRODUCTION_HOSTS,
+    'database': [PRODUCTION_HOST],
+    'pooler': [PRODUCTION_HOST],
+    'smtp': [PRODUCTION_HOST],
+}
+DJANGO_WEIGHTS = {} # Django host => its share of requests relative to the others (default 1)
+# Host => the address the other hosts reach it on, e.g. its private network IP.
+# Apache and pgbouncer listen there for the other hosts, so on a multi-host
+# setup don't leave a host's public SSH address as the default.
+PRIVATE_ADDRESSES = {}
 ADMIN_EMAIL = 'andrewbadr+django_fabfile@gmail.com'
 
 # Probably don't change:
 DJANGO_PORT = 81
 BRANCH = 'master'
 SERVER_GROUP = 'app'
-ROLES = ['nginx', 'django', 'database', 'smtp']
+ROLES = ['nginx', 'django', 'database', 'pooler', 'smtp']
 PROJECT_DIR = '/project/%s' % PROJECT_NAME # Not templatized in config files
 VIRTUALENV = '/envs/%s' % PROJECT_NAME # Not templatized in config files
+# 'shared': pip installs into VIRTUALENV in place.
+# 'wheelhouse': wheels are built locally once, and VIRTUALENV becomes a symlink to
+# a virtualenv keyed on the requirements hash (see Pip.install_requirements_cached).
+PIP_MODE = 'shared'
+WHEELHOUSE = './server/wheelhouse' # Local; one subdir of wheels per requirements hash
 DB_PASS = 'foo' # Should not contain quotes; coupled w/settings.py # IGNORED, postgres is now configured to trust local connections
 GIT_CLONE_USERNAME = 'git'
 GIT_CLONE_HOST = 'github.com'
 GIT_CLONE_PSEUDOHOST = PROJECT_NAME # Used to specify site-specific behavior for SSH if multiple projects are hosted on e.g. github.com
 PG_VERSION = (8, 4)
+PG_RELOADABLE_CONFIG = ['pg_hba.conf', 'pg_ident.conf'] # Changes to other config files need a restart
+# postgresql.conf's memory and checkpoint settings are computed from the host's
+# RAM and disks (see _pg_tuning) for one of these workloads:
+#   'web'   - many short queries (OLTP)
+#   'mixed' - web plus some reporting
+#   'batch' - few, big queries
+PG_PROFILE = 'web'
+PG_MEMORY_SHARE = 0.5 # Of the host's RAM. 0.5 leaves room for Django on a one-box setup; use 1.0 on database-only hosts
+PG_MAX_CONNECTIONS = 50 # Without USE_POOLER, configure_django checks persistent connections fit in this
+# pgbouncer in transaction mode, next to Postgres. Django connects to it rather
+# than to Postgres; see server/pooler/pgbouncer.ini.
+USE_POOLER = False
+POOLER_PORT = 6432
+POOLER_POOL_SIZE = 20 # Server connections per database/user; keep it under PG_MAX_CONNECTIONS
 PYTHON_VERSION = (2,6)
+# mod_wsgi daemon processes and threads are sized from the host (see _wsgi_sizing)
+WSGI_MEMORY_SHARE = 0.4 # Of the host's RAM, for Django; leaves room for Postgres on a one-box setup
+WSGI_PROCESS_MB = 100 # Rough resident size of one Django process
+WSGI_REQUESTS_PER_CPU = 4 # Concurrent requests per CPU; most of a request is spent waiting on the database
+WSGI_MAX_REQUESTS = 1000 # Processes are replaced after this many requests, to bound leaks
+# nginx caches anonymous GETs proxied to Django for this long, so a burst of
+# hits on one page reaches Django about once a second. 0 disables it.
+# Needs nginx 1.1.12+ for cache locking; older versions go without.
+NGINX_MICROCACHE_SECONDS = 1
+PARALLEL_POOL_SIZE = 10 # Max hosts worked on at once by the parallel tasks
+TIMINGS_FILENAME = 'timings.json' # Per-release record of deploy phase times; coupled w/common prep_release
+# How Deploy.upload_new_release gets the code onto the server:
+#   'clone'   - git clone from GitHub on the server
+#   'mirror'  - git fetch into a bare mirror under packages/, clone from that
+#   'archive' - git archive locally, upload one .tar.gz per host
+#   'rsync'   - rsync the archived tree, hardlinking unchanged files from `current`
+RELEASE_UPLOAD_MODE = 'clone'
+# How deploy_activate_release puts a release live:
+#   'graceful'  - switch `current` and gracefully restart Apache
+#   'candidate' - first serve it from a separate mod_wsgi daemon on CANDIDATE_PORT and check
+#                 ACTIVATION_CHECK_URLS there, and only then switch `current` and restart
+#                 Apache. That daemon only checks the release; the live daemons start
+#                 fresh, preloading it. The checks run again once it's live; if they fail,
+#                 the previous release is switched back in. Hosts set up before this mode
+#                 existed need update_config run once for the candidate vhost.
+ACTIVATION_MODE = 'candidate'
+CANDIDATE_PORT = 82
+ACTIVATION_CHECK_URLS = ['/'] # Must all return 200
+ACTIVATION_WARM_ROUNDS = 3 # Untimed requests to each URL first, to load code and fill caches
+ACTIVATION_CHECK_ROUNDS = 3
+ACTIVATION_MAX_SECONDS = 1.0 # Highest median response time allowed per URL
+# benchmark_release requests a weighted mix of paths from the machine fab runs on
+BENCHMARK_URLS = [('/', 1)] # (path, weight)
+BENCHMARK_CONCURRENCY = 10 # Clients, each with its own keep-alive connection
+BENCHMARK_SECONDS = 30
+BENCHMARK_WARMUP_SECONDS = 5 # Untimed requests first, to load code and fill caches
+BENCHMARK_HEADERS = {'Cookie': 'messages='} # Skips nginx's micro-cache, so it's Django being measured
+BENCHMARK_MAX_SLOWDOWN = 0.1 # Latency up or throughput down by more than this vs the previous release is a regression,
+BENCHMARK_MIN_SLOWDOWN_MS = 5 # unless latency is up by less than this
+BENCHMARKS_FILENAME = 'benchmark.json' # Per-release record of benchmark_release runs, next to TIMINGS_FILENAME
+BENCHMARKS_DIR = './server/benchmarks' # Local; records of runs against a local server, one per release name
+# Fabric keeps one connection per host for run/sudo/put. These options let the
+# ssh processes we start ourselves (rsync) share a single connection too.
+SSH_MULTIPLEX_OPTS = '-o ControlMaster=auto -o ControlPath=/tmp/fab-%r@%h:%p -o ControlPersist=60'
 
 #
 # Fabric Hacks
@@ -44,14 +131,48 @@ PYTHON_VERSION = (2,6)
 run = functools.partial(run)
 sudo = functools.partial(sudo)
 
-def upload_template(src, dest, *args, **kwargs):
+class Batch(object):
     """
-    Wrapper around Fabric's upload_template that sets +r.
+    Queues remote commands and runs them as one shell script, in a single
+    round trip, when flushed or when its `with` block ends without error.
 
-    upload_template does not preserve file permissions, http://code.fabfile.org/issues/show/117
+    Only for commands whose output isn't needed and which are fine to
+    rerun; the script stops at the first failing command.
+
+    E.g.:
+        with Batch(use_sudo=True) as batch:
+            for f in files:
+                batch.add('chown postgres %s' % f)
     """
-    orig_upload_template(src, dest, *args, **kwargs)
-    sudo('chmod +r %s' % dest)
+    def __init__(self, use_sudo=False):
+        self.use_sudo = use_sudo
+        self.commands = []
+
+    def add(self, cmd):
+        self.commands.append(cmd)
+
+    def flush(self):
+        if not self.commands:
+            return
+        script = '\n'.join(['set -e'] + self.commands)
+        self.commands = []
+        runner = sudo if self.use_sudo else run
+        return runner(script)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+def _lookup_task(name):
+    # TODO: switch to fabric namespaces
+    if '.' not in name:
+        return globals()[name]
+    box, task = name.split('.', 1)
+    box = globals()[box]
+    return getattr(box, task)
 
 def boxed_task(name):
     """
@@ -59,10 +180,7 @@ def boxed_task(name):
    
     E.g.: 'boxed_task:Pip.install_requirements'
     """
-    # TODO: switch to fabric namespaces
-    box, task = name.split('.', 1)
-    box = globals()[box]
-    task = getattr(box, task)
+    task = _lookup_task(name)
     task()
 
 
@@ -76,6 +194,88 @@ def home_dir(*args):
         return os.path.join("/root", *args)
     return os.path.join("/home/%s" % env.user, *args)
 
+def render_template(src, context):
+    """
+    Renders a Jinja config template locally, as upload_template(use_jinja=True)
+    would, except that a block tag's line doesn't leave a blank line behind.
+    """
+    from jinja2 import Environment, FileSystemLoader
+    dirname, filename = os.path.split(src)
+    jenv = Environment(loader=FileSystemLoader(dirname or '.'), trim_blocks=True)
+    return jenv.get_template(filename).render(**context).encode('utf-8')
+
+def sync_templates(templates, owner=None):
+    """
+    Uploads the rendered templates whose remote copy differs, and returns
+    the list of remote paths that changed.
+
+    `templates` is a list of (src, dest, context). All the remote files are
+    checksummed in one round trip; unchanged ones are not uploaded, so the
+    caller can skip reloading their service.
+    """
+    rendered = [(dest, render_template(src, context)) for src, dest, context in templates]
+    output = sudo('md5sum %s 2>/dev/null || true' % ' '.join(dest for dest, text in rendered))
+    remote_hashes = {}
+    for line in output.splitlines():
+        if line.strip():
+            file_hash, path = line.split(None, 1)
+            remote_hashes[path.strip()] = file_hash
+    changed = []
+    with Batch(use_sudo=True) as batch:
+        for dest, text in rendered:
+            if remote_hashes.get(dest) == hashlib.md5(text).hexdigest():
+                continue
+            put(StringIO(text), dest, use_sudo=True)
+            # put does not preserve file permissions, http://code.fabfile.org/issues/show/117
+            batch.add('chmod +r %s' % dest)
+            if owner:
+                batch.add('chown %s %s' % (owner, dest))
+            changed.append(dest)
+    for dest in changed:
+        print 'Updated', dest
+    return changed
+
+_host_facts = {}
+
+def _get_host_facts():
+    """
+    Returns the RAM (mem_mb), CPU count (cpus), disk type (ssd), shared
+    memory limits (shmmax in bytes, shmall in pages of page_size) and
+    system-wide open file limit (file_max) of the current host. Probed in
+    one round trip, then remembered for the rest of the run.
+    """
+    if env.host_string in _host_facts:
+        return _host_facts[env.host_string]
+    with hide('running', 'stdout'):
+        output = run(' ; '.join([
+            "echo mem_kb $(awk '/^MemTotal:/ {print $2}' /proc/meminfo)",
+            "echo cpus $(grep -c ^processor /proc/cpuinfo)",
+            "echo rotational $(cat /sys/block/[hsv]d*/queue/rotational /sys/block/xvd*/queue/rotational"
+                " /sys/block/nvme*/queue/rotational 2>/dev/null)",
+            "echo shmmax $(cat /proc/sys/kernel/shmmax)",
+            "echo shmall $(cat /proc/sys/kernel/shmall)",
+            "echo page_size $(getconf PAGE_SIZE)",
+            "echo file_max $(cat /proc/sys/fs/file-max)",
+        ]))
+    values = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if parts:
+            values[parts[0]] = parts[1:]
+    rotational = values.get('rotational', [])
+    facts = {
+        'mem_mb': int(values['mem_kb'][0]) // 1024,
+        'cpus': int(values['cpus'][0]),
+        # Unknown counts as spinning: its settings are safe on SSDs too
+        'ssd': bool(rotational) and '1' not in rotational,
+        'shmmax': int(values['shmmax'][0]),
+        'shmall': int(values['shmall'][0]),
+        'page_size': int(values['page_size'][0]),
+        'file_max': int(values['file_max'][0]),
+    }
+    _host_facts[env.host_string] = facts
+    return facts
+
 #
 # Stage management
 #
@@ -83,23 +283,170 @@ def home_dir(*args):
 def stage_dev():
     env.user = os.getenv('USER')
     env.stage = {
-        'hostname': 'dev.' + DOMAIN
+        'hostname': 'dev.' + DOMAIN,
+        'cached_templates': False,
+        'persistent_db_connections': False,
+        'server_timing': True,
     }
-    env.hosts = [env.stage['hostname']]
+    _set_topology(_one_host_topology(env.stage['hostname']))
 
 def stage_staging():
     env.user = PRODUCTION_USERNAME
     env.stage = {
-        'hostname': 'staging.' + DOMAIN
+        'hostname': 'staging.' + DOMAIN,
+        'cached_templates': True,
+        'persistent_db_connections': True,
+        'server_timing': True,
     }
-    env.hosts = [env.stage['hostname']]
+    _set_topology(_one_host_topology(env.stage['hostname']))
 
 def stage_production():
     env.user = PRODUCTION_USERNAME
     env.stage = {
-        'hostname': 'www.' + DOMAIN
+        'hostname': 'www.' + DOMAIN,
+        'cached_templates': True,
+        'persistent_db_connections': True,
+        'server_timing': False,
     }
-    env.hosts = [PRODUCTION_HOST]
+    _set_topology(PRODUCTION_TOPOLOGY)
+
+def _one_host_topology(host):
+    return dict((role, [host]) for role in ROLES)
+
+def _set_topology(topology):
+    """
+    Makes the roles available as Fabric roles (e.g. fab -R django ...), and
+    runs tasks on every host that has one, unless they say otherwise.
+    """
+    env.roledefs = dict((role, list(topology.get(role, []))) for role in ROLES)
+    env.hosts = _role_hosts(*ROLES)
+
+def _role_hosts(*roles):
+    hosts = []
+    for role in roles:
+        for host in env.roledefs[role]:
+            if host not in hosts:
+                hosts.append(host)
+    return hosts
+
+def _has_role(role):
+    return env.host_string in env.roledefs[role]
+
+def _private_address(host):
+    if host not in PRIVATE_ADDRESSES:
+        print 'Warning: %s has no PRIVATE_ADDRESSES entry; using its SSH address' % host
+    return PRIVATE_ADDRESSES.get(host, normalize(host)[1])
+
+def _listen_addresses(client_role):
+    """Where a service on this host should listen so every `client_role` host can reach it."""
+    addresses = ['127.0.0.1']
+    if [host for host in env.roledefs[client_role] if host != env.host_string]:
+        addresses.append(_private_address(env.host_string))
+    return addresses
+
+def _client_addresses(client_role):
+    """The addresses `client_role` hosts connect to this host from."""
+    return [_host_address(host) for host in env.roledefs[client_role]]
+
+def _host_address(host):
+    """How the current host reaches `host` on the private side, e.g. nginx reaching Django."""
+    if host == env.host_string:
+        return '127.0.0.1'
+    return _private_address(host)
+
+#
+# Parallel execution
+#
+
+class Parallel(object):
+    """
+    Runs a function once per host, several hosts at a time.
+
+    Each host gets its own forked process. Its output is buffered and printed
+    as one block when the host finishes, so lines from different hosts don't
+    interleave. A failing host doesn't stop the others; failures are
+    collected and reported together at the end.
+    """
+
+    @staticmethod
+    def _work(func, args, host, results):
+        # Runs in the child. Don't share SSH connections made by the parent.
+        from fabric.state import connections
+        connections.clear()
+        output = StringIO()
+        sys.stdout = sys.stderr = output
+        error = None
+        try:
+            with settings(host_string=host):
+                func(*args)
+        except SystemExit: # abort() has already printed its message
+            error = 'aborted'
+        except BaseException, e: # KeyboardInterrupt too; the parent waits for every host
+            traceback.print_exc()
+            error = '%s: %s' % (e.__class__.__name__, e)
+        results.put((host, error, output.getvalue()))
+
+    @staticmethod
+    def execute(func, *args, **kwargs):
+        """
+        Calls func(*args) on each of `hosts` (default env.hosts), at most
+        `pool_size` (default PARALLEL_POOL_SIZE) at once.
+
+        Returns a dict of host => error message for the hosts that failed.
+        A host whose process dies without reporting (killed, os._exit) has
+        failed too.
+        """
+        hosts = list(kwargs.get('hosts') or env.hosts)
+        pool_size = int(kwargs.get('pool_size') or PARALLEL_POOL_SIZE)
+        assert pool_size > 0
+        results = multiprocessing.Queue()
+        pending = hosts[:]
+        workers = {}
+        failures = {}
+        while pending or workers:
+            while pending and len(workers) < pool_size:
+                host = pending.pop(0)
+                worker = multiprocessing.Process(target=Parallel._work, args=(func, args, host, results))
+                worker.start()
+                workers[host] = worker
+            # A child's result is in the queue before its process ends, so the
+            # ones already dead that don't answer now never will
+            dead = [h for h, worker in workers.items() if not worker.is_alive()]
+            try:
+                finished = [results.get(timeout=1)]
+            except Queue.Empty:
+                finished = []
+                for host in dead:
+                    workers[host].join()
+                    finished.append((host, 'process died with exit code %s' % workers[host].exitcode, ''))
+            for host, error, output in finished:
+                workers.pop(host).join()
+                print '=' * 20, host, 'FAILED' if error else 'done', '=' * 20
+                sys.stdout.write(output)
+                if error:
+                    failures[host] = error
+        print '*' * 20
+        print '%d of %d hosts succeeded' % (len(hosts) - len(failures), len(hosts))
+        for host in hosts:
+            if host in failures:
+                print '  FAILED %s: %s' % (host, failures[host])
+        print '*' * 20
+        return failures
+
+@runs_once
+def parallel(task_name, *args, **kwargs):
+    """
+    Runs a task on all of env.hosts at once, e.g. 'parallel:bootstrap_everything',
+    or on the hosts of its @roles.
+
+    Extra args go to the task; 'pool_size=N' limits how many hosts run at once.
+    """
+    pool_size = kwargs.pop('pool_size', None)
+    task = _lookup_task(task_name)
+    hosts = getattr(task, 'roles', None) and _role_hosts(*task.roles)
+    failures = Parallel.execute(task, *args, hosts=hosts, pool_size=pool_size)
+    if failures:
+        abort('%s failed on: %s' % (task_name, ', '.join(sorted(failures))))
 
 #
 # Tasks
@@ -123,11 +470,71 @@ class Pip(object):
     @staticmethod
     def install(*pkgs):
         pip =  os.path.join(VIRTUALENV, 'bin', 'pip')
-        for pkg in pkgs:
-            run('%s install -U %s' % (pip, pkg))
+        run('%s install -U %s' % (pip, ' '.join(pkgs)))
+
+    @staticmethod
+    def requirements_hash():
+        digest = hashlib.md5(open('./server/requirements.txt').read())
+        digest.update('python%d.%d' % PYTHON_VERSION)
+        return digest.hexdigest()[:12]
+
+    @staticmethod
+    def build_wheelhouse():
+        """
+        Builds wheels for server/requirements.txt into WHEELHOUSE/<hash>, once.
+
+        Wheels for compiled packages are built for the local platform, so
+        build on a machine that matches the servers. If the directory already
+        exists (e.g. copied from a build box), it is used as-is and nothing
+        is downloaded.
+        """
+        wheel_dir = os.path.join(WHEELHOUSE, Pip.requirements_hash())
+        if os.path.exists(wheel_dir):
+            return wheel_dir
+        tmp_dir = wheel_dir + '.tmp'
+        local('rm -rf %s' % tmp_dir)
+        local('pip wheel --wheel-dir=%s -r ./server/requirements.txt' % tmp_dir)
+        local('mv %s %s' % (tmp_dir, wheel_dir))
+        return wheel_dir
+
+    @staticmethod
+    def install_requirements_cached():
+        """
+        Points VIRTUALENV at a virtualenv built for the current requirements.
+
+        The virtualenv lives next to VIRTUALENV, named after the requirements
+        hash. If it is already complete, pip doesn't run at all. Otherwise it
+        is built offline from the wheelhouse, then the VIRTUALENV symlink is
+        swapped to it atomically. pip installs requirements.txt itself, so a
+        requirement the wheelhouse has no wheel for fails the build rather
+        than being left out. The old env is left in place for rollbacks.
+        Restart Django afterwards to pick it up.
+        """
+        requirements_hash = Pip.requirements_hash()
+        env_dir = '%s-%s' % (VIRTUALENV, requirements_hash)
+        if exists(os.path.join(env_dir, '.complete')):
+            print 'Requirements unchanged; reusing', env_dir
+        else:
+            wheel_dir = Pip.build_wheelhouse()
+            remote_wheel_dir = os.path.join(PROJECT_DIR, 'packages', 'wheelhouse', requirements_hash)
+            run('mkdir -p %s' % remote_wheel_dir)
+            put(os.path.join(wheel_dir, '*.whl'), remote_wheel_dir)
+            remote_requirements = os.path.join(remote_wheel_dir, 'requirements.txt')
+            put('./server/requirements.txt', remote_requirements)
+            sudo('rm -rf %s && mkdir -p %s' % (env_dir, env_dir))
+            set_up_permissions(env_dir)
+            run('virtualenv %s' % env_dir)
+            pip = os.path.join(env_dir, 'bin', 'pip')
+            run('%s install --no-index --find-links=%s -r %s' % (pip, remote_wheel_dir, remote_requirements))
+            run('touch %s' % os.path.join(env_dir, '.complete'))
+        # The first time through, move aside the plain directory `shared` mode made
+        sudo('if [ -d %s -a ! -L %s ]; then mv %s %s-shared; fi' % (VIRTUALENV, VIRTUALENV, VIRTUALENV, VIRTUALENV))
+        make_symlink_atomically(env_dir, VIRTUALENV, use_sudo=True)
 
     @staticmethod
     def install_requirements():
+        if PIP_MODE == 'wheelhouse':
+            return Pip.install_requirements_cached()
         REMOTE_FILENAME = './tmp_requirements.txt'
         pip =  os.path.join(VIRTUALENV, 'bin', 'pip')
         put('./server/requirements.txt', REMOTE_FILENAME)
@@ -135,8 +542,7 @@ class Pip(object):
         run('rm %s' % REMOTE_FILENAME)
 
 def set_up_permissions(dirname):
-    sudo('chown -R %s:%s %s' % (env.user, SERVER_GROUP, dirname))
-    sudo('chmod -R g+w %s' % dirname)
+    sudo('chown -R %s:%s %s && chmod -R g+w %s' % (env.user, SERVER_GROUP, dirname, dirname))
 
 def adduser(username):
     # Idempotent (non-failing) version of adduser
@@ -156,25 +562,42 @@ def bootstrap_everything():
     configure_database()
     configure_smtp()
     restart_database() # Must be done before deploy so that syncdb works
+    if USE_POOLER:
+        install_pooler()
+        configure_pooler()
+        restart_pooler()
     simple_deploy()
     restart_database()
     restart_django() # Must be done before nginx so that port 80 is free
     restart_nginx()
     restart_smtp()
 
+@roles('database')
 def bootstrap_database():
     install_common()
     install_database()
     configure_database()
     restart_database()
+    if USE_POOLER:
+        bootstrap_pooler()
 
+@roles('pooler')
+def bootstrap_pooler():
+    install_common()
+    install_pooler()
+    configure_pooler()
+    restart_pooler()
+
+@roles('nginx')
 def bootstrap_nginx():
     install_common()
     install_nginx()
     configure_nginx()
-    deploy()
+    if _has_role('django'): # Releases only go to django hosts
+        deploy()
     restart_nginx()
 
+@roles('django')
 def bootstrap_django():
     install_common()
     install_django()
@@ -182,6 +605,7 @@ def bootstrap_django():
     deploy()
     restart_django()
 
+@roles('smtp')
 def bootstrap_smtp():
     install_common()
     install_smtp()
@@ -207,11 +631,13 @@ def install_common():
     sudo('easy_install -U setuptools')
     sudo('easy_install pip')
     adduser(SERVER_GROUP)
-    for dirname in ['releases', 'packages', 'bin', 'log']:
-        sudo('mkdir -p %s' % os.path.join(PROJECT_DIR, dirname))
-    set_up_permissions('/project')
+    dirnames = ['releases', 'packages', 'bin', 'log', 'static_store']
     log_dir = os.path.join(PROJECT_DIR, 'log')
-    sudo('chmod g+s %s' % log_dir)
+    with Batch(use_sudo=True) as batch:
+        batch.add('mkdir -p %s' % ' '.join(os.path.join(PROJECT_DIR, d) for d in dirnames))
+        batch.add('chown -R %s:%s /project' % (env.user, SERVER_GROUP))
+        batch.add('chmod -R g+w /project')
+        batch.add('chmod g+s %s' % log_dir)
     install_keys()
 
 def _key_destination(public=True):
@@ -226,11 +652,13 @@ def install_keys():
     # if you don't want that.
     put('./server/id_rsa', _key_destination(public=False))
     put('./server/id_rsa.pub', _key_destination())
-    run('chmod 600 %s' % _key_destination(public=False))
 
     # So we can git clone from git@github.com w/o manual confirmation:
     put('./server/known_hosts', home_dir('.ssh/known_hosts'))
 
+    batch = Batch()
+    batch.add('chmod 600 %s' % _key_destination(public=False))
+
     # Add SSH configuration...
     config_file = home_dir('.ssh/config')
     lines =  [
@@ -244,8 +672,9 @@ def install_keys():
     # Therefore, just append for now until something needs to change. (SSH uses first match.)
     for l in lines:
         assert "'" not in l
-        run("echo '%s' >> %s" % (l, config_file))
-    run("echo '%s' >> %s" % ('', config_file))
+        batch.add("echo '%s' >> %s" % (l, config_file))
+    batch.add("echo '%s' >> %s" % ('', config_file))
+    batch.flush()
 
 def install_nginx():
     Apt.install('nginx')
@@ -253,20 +682,13 @@ def install_nginx():
     if exists('/etc/nginx/sites-enabled/default'):
         sudo('rm /etc/nginx/sites-enabled/default')
 
-#def install_processor():
-#    """
-#    Stuff to compile javascript
-#    """
-#    put('./server/processor/compiler.jar', os.path.join(PROJECT_DIR, 'bin', 'compiler.jar'))
-#    put('./server/processor/processor', os.path.join(PROJECT_DIR, 'bin', 'processor'))
-#    sudo('chmod +x %s' % os.path.join(PROJECT_DIR, 'bin', 'processor'))
-
 def install_django():
     Pip.install_virtualenv()
-    if not exists(VIRTUALENV): # TODO: better test than `exists`?
-        sudo('mkdir -p %s' % VIRTUALENV)
-        sudo('virtualenv %s' % VIRTUALENV)
-    set_up_permissions(VIRTUALENV)
+    if PIP_MODE == 'shared':
+        if not exists(VIRTUALENV): # TODO: better test than `exists`?
+            sudo('mkdir -p %s' % VIRTUALENV)
+            sudo('virtualenv %s' % VIRTUALENV)
+        set_up_permissions(VIRTUALENV)
     Pip.install_requirements()
     Apt.install('apache2', 'postgresql-client', 'libapache2-mod-wsgi')
     if exists('/etc/apache2/sites-enabled/000-default'):
@@ -289,40 +711,125 @@ def install_database():
     Apt.install('postgresql')
     restart_database()
 
+def install_pooler():
+    Apt.install('pgbouncer')
+
+def _nginx_version():
+    """The installed nginx's version as a tuple, e.g. (0, 7, 65)."""
+    with hide('running', 'stdout'):
+        output = run('nginx -v 2>&1') # "nginx version: nginx/0.7.65", or "nginx/1.18.0 (Ubuntu)"
+    match = re.search(r'/(\d+(?:\.\d+)*)', output)
+    if not match:
+        abort("Couldn't tell nginx's version from: %s" % output)
+    return tuple(int(n) for n in match.group(1).split('.'))
+
+def _nginx_sizing(facts):
+    """
+    A worker per CPU, each allowed an even share of half the system's open
+    files (see _get_host_facts). A proxied request takes two of them.
+    """
+    workers = facts['cpus']
+    files_per_worker = max(1024, min(65536, facts['file_max'] // 2 // workers))
+    return workers, files_per_worker, files_per_worker // 2
+
 def configure_nginx():
-    put('./server/nginx/nginx.conf', '/etc/nginx/nginx.conf', use_sudo=True)
-    upload_template( './server/nginx/site', '/etc/nginx/sites-available/%s' % PROJECT_NAME, 
-            use_sudo=True, use_jinja=True, context={
-        'hostname': env.stage['hostname'],
-        'django_host': '127.0.0.1', # Change this on switch to a multi-server setup
-        'DJANGO_PORT': DJANGO_PORT,
-        'DOMAIN': DOMAIN,
-        'PROJECT_NAME': PROJECT_NAME
-    })
-    if not exists('/etc/nginx/sites-enabled/%s' % PROJECT_NAME):
-        sudo('ln -s /etc/nginx/sites-available/%s /etc/nginx/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+    """Returns the list of config files that changed."""
+    workers, files_per_worker, connections = _nginx_sizing(_get_host_facts())
+    version = _nginx_version()
+    django_servers = [(_host_address(host), DJANGO_WEIGHTS.get(host, 1)) for host in env.roledefs['django']]
+    changed = sync_templates([
+        ('./server/nginx/nginx.conf', '/etc/nginx/nginx.conf', {
+            'worker_processes': workers,
+            'worker_rlimit_nofile': files_per_worker,
+            'worker_connections': connections,
+        }),
+        ('./server/nginx/site', '/etc/nginx/sites-available/%s' % PROJECT_NAME, {
+            'hostname': env.stage['hostname'],
+            'django_servers': django_servers,
+            'DJANGO_PORT': DJANGO_PORT,
+            'DOMAIN': DOMAIN,
+            'PROJECT_NAME': PROJECT_NAME,
+            # Releases only go to django hosts; elsewhere, Apache serves /static
+            'local_static': _has_role('django'),
+            'least_conn': version >= (1, 3, 1),
+            'upstream_keepalive': version >= (1, 1, 4),
+            'microcache_seconds': NGINX_MICROCACHE_SECONDS if version >= (1, 1, 12) else 0,
+        }),
+    ])
+    sudo('ln -nfs /etc/nginx/sites-available/%s /etc/nginx/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+    return changed
+
+def _wsgi_sizing(facts):
+    """
+    mod_wsgi daemon processes and threads for a host with `facts` (see
+    _get_host_facts): a process per CPU, as memory allows, and enough threads
+    for WSGI_REQUESTS_PER_CPU concurrent requests per CPU.
+    """
+    memory_limit = int(facts['mem_mb'] * WSGI_MEMORY_SHARE) // WSGI_PROCESS_MB
+    processes = max(1, min(facts['cpus'], memory_limit))
+    concurrency = facts['cpus'] * WSGI_REQUESTS_PER_CPU
+    threads = max(1, min(15, -(-concurrency // processes))) # Rounded up
+    return processes, threads
 
-def configure_django():
-    upload_template('./server/django/wsgi.py', os.path.join(PROJECT_DIR, 'wsgi.py'), use_jinja=True, context={
-        'PROJECT_NAME': PROJECT_NAME,
-        'PYTHON_VERSION_STR': "%d.%d" % PYTHON_VERSION,
-    })
-    upload_template('./server/django/vhost', '/etc/apache2/sites-available/%s' % PROJECT_NAME, use_sudo=True, use_jinja=True, context={
-        'DJANGO_PORT': DJANGO_PORT,
-        'PROJECT_NAME': PROJECT_NAME,
-        'DOMAIN': DOMAIN, # Should we use env.stage['hostname']?
-        'ADMIN_EMAIL': ADMIN_EMAIL
+def _check_db_connections(processes, threads):
+    """
+    With persistent connections and no pooler, each Django thread keeps a
+    Postgres connection open: twice over while a graceful restart overlaps
+    old and new processes, plus the candidate daemon's. Aborts if that could
+    be more than Postgres allows, assuming every django host is sized like
+    this one.
+    """
+    if not env.stage['persistent_db_connections'] or USE_POOLER:
+        return
+    per_host = processes * threads * 2 + threads
+    needed = per_host * len(env.roledefs['django'])
+    available = PG_MAX_CONNECTIONS - 5 # Leaves some for superusers, cron and manage.py
+    if needed > available:
+        abort("Persistent connections could take %d of Postgres's connections (%d per django host), "
+              "but only %d are free. Turn on USE_POOLER, raise PG_MAX_CONNECTIONS, or set "
+              "persistent_db_connections to False for this stage." % (needed, per_host, available))
 
-    })
-    upload_template('./server/django/ports.conf', '/etc/apache2/ports.conf', use_sudo=True, use_jinja=True, context={
-        'DJANGO_PORT': DJANGO_PORT,
-    })
-    upload_template('./server/django/stagesettings.py', os.path.join(PROJECT_DIR, 'stagesettings.py'), use_sudo=True, 
-        use_jinja=True, context={
-        'database_host': '127.0.0.1', # Change this on swtich to a multi-server setup
-    })
-    if not exists('/etc/apache2/sites-enabled/%s' % PROJECT_NAME):
-        sudo('ln -s /etc/apache2/sites-available/%s /etc/apache2/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+def configure_django():
+    """Returns the list of config files that changed."""
+    processes, threads = _wsgi_sizing(_get_host_facts())
+    _check_db_connections(processes, threads)
+    changed = sync_templates([
+        ('./server/django/wsgi.py', os.path.join(PROJECT_DIR, 'wsgi.py'), {
+            'PROJECT_NAME': PROJECT_NAME,
+            'PYTHON_VERSION_STR': "%d.%d" % PYTHON_VERSION,
+            'release_link': 'current',
+        }),
+        # Serves the `candidate` release on CANDIDATE_PORT; see Deploy.activate_checked
+        ('./server/django/wsgi.py', os.path.join(PROJECT_DIR, 'candidate_wsgi.py'), {
+            'PROJECT_NAME': PROJECT_NAME,
+            'PYTHON_VERSION_STR': "%d.%d" % PYTHON_VERSION,
+            'release_link': 'candidate',
+        }),
+        ('./server/django/vhost', '/etc/apache2/sites-available/%s' % PROJECT_NAME, {
+            'DJANGO_PORT': DJANGO_PORT,
+            'PROJECT_NAME': PROJECT_NAME,
+            'DOMAIN': DOMAIN, # Should we use env.stage['hostname']?
+            'ADMIN_EMAIL': ADMIN_EMAIL,
+            'wsgi_processes': processes,
+            'wsgi_threads': threads,
+            'wsgi_max_requests': WSGI_MAX_REQUESTS,
+            'CANDIDATE_PORT': CANDIDATE_PORT,
+            'nginx_addresses': sorted(set(['127.0.0.1'] + _client_addresses('nginx'))),
+        }),
+        ('./server/django/ports.conf', '/etc/apache2/ports.conf', {
+            'DJANGO_PORT': DJANGO_PORT,
+            'listen_addresses': _listen_addresses('nginx'),
+            'CANDIDATE_PORT': CANDIDATE_PORT,
+        }),
+        ('./server/django/stagesettings.py', os.path.join(PROJECT_DIR, 'stagesettings.py'),
+            dict(_database_address(), **{
+            'cached_templates': env.stage['cached_templates'],
+            'persistent_db_connections': env.stage['persistent_db_connections'],
+            'server_timing': env.stage['server_timing'],
+        })),
+    ])
+    sudo('ln -nfs /etc/apache2/sites-available/%s /etc/apache2/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+    return changed
 
 def configure_smtp():
     main_cf = '/etc/postfix/main.cf'
@@ -351,28 +858,135 @@ def run_with_safe_error(cmd, safe_error, use_sudo=False, user=None):
             "  Actual error: %s" % result
             )
 
+def _pg_tuning(facts):
+    """
+    postgresql.conf settings for PG_PROFILE on a host with `facts` (see
+    _get_host_facts), along the lines of pgtune. Memory is in kB.
+    """
+    profile = {
+        # work_mem_divisor: sorts/hashes a connection may run at once
+        'web':   {'work_mem_divisor': 3, 'maintenance_share': 16, 'checkpoint_segments': 32,
+                  'checkpoint_completion_target': 0.7, 'default_statistics_target': 100},
+        'mixed': {'work_mem_divisor': 2, 'maintenance_share': 16, 'checkpoint_segments': 32,
+                  'checkpoint_completion_target': 0.9, 'default_statistics_target': 100},
+        'batch': {'work_mem_divisor': 0.5, 'maintenance_share': 8, 'checkpoint_segments': 128,
+                  'checkpoint_completion_target': 0.9, 'default_statistics_target': 500},
+    }[PG_PROFILE]
+    mem_kb = int(facts['mem_mb'] * 1024 * PG_MEMORY_SHARE)
+    shared_buffers = min(mem_kb // 4, 8 * 1024 * 1024) # Past ~8GB, 8.x gains little
+    wal_buffers = max(64, min(shared_buffers * 3 // 100, 16 * 1024))
+    work_mem = int((mem_kb - shared_buffers) / (PG_MAX_CONNECTIONS * profile['work_mem_divisor']))
+    # SysV shared memory: shared_buffers, wal_buffers and per-connection overhead
+    shmmax = (shared_buffers + wal_buffers) * 1024 * 11 // 10 + 32 * 1024 * 1024
+    return {
+        'max_connections': PG_MAX_CONNECTIONS,
+        'shared_buffers': '%dkB' % shared_buffers,
+        'effective_cache_size': '%dkB' % (mem_kb * 3 // 4),
+        'work_mem': '%dkB' % max(work_mem, 1024),
+        'maintenance_work_mem': '%dkB' % min(mem_kb // profile['maintenance_share'], 2 * 1024 * 1024),
+        'wal_buffers': '%dkB' % wal_buffers,
+        'checkpoint_segments': profile['checkpoint_segments'],
+        'checkpoint_completion_target': profile['checkpoint_completion_target'],
+        'default_statistics_target': profile['default_statistics_target'],
+        'random_page_cost': 1.1 if facts['ssd'] else 4.0,
+        'effective_io_concurrency': 200 if facts['ssd'] else 2,
+        # Never lower what's there: something else may need it
+        'shmmax': max(shmmax, facts['shmmax']),
+        'shmall': max(shmmax // facts['page_size'], facts['shmall']),
+    }
+
+def _database_address():
+    """Where Django on this host connects to: the pooler, if it's used, or Postgres."""
+    if USE_POOLER:
+        return {'database_host': _host_address(env.roledefs['pooler'][0]), 'database_port': POOLER_PORT}
+    database = env.roledefs['database'][0]
+    if database == env.host_string:
+        return {'database_host': '', 'database_port': ''} # The local socket
+    return {'database_host': _host_address(database), 'database_port': ''}
+
+def _database_clients():
+    """The roles that connect to Postgres directly."""
+    return 'pooler' if USE_POOLER else 'django'
+
 def configure_database():
+    """Returns the list of config files that changed."""
     config_dir = '/etc/postgresql/%d.%d/main' % PG_VERSION
     sudo('mkdir -p %s' % config_dir)
+    tuning = _pg_tuning(_get_host_facts())
+    shm_conf = '/etc/sysctl.d/30-postgresql-shm.conf'
+    if sync_templates([('./server/database/sysctl.conf', shm_conf, {
+            'shmmax': tuning['shmmax'],
+            'shmall': tuning['shmall'],
+            })]):
+        sudo('sysctl -p %s' % shm_conf) # Before Postgres restarts with the bigger shared_buffers
+    templates = []
     for filename in ['environment', 'pg_ctl.conf', 'pg_hba.conf', 'pg_ident.conf', 'postgresql.conf', 'start.conf']:
         local_file = os.path.join('./server/database', filename)
         remote_file = os.path.join(config_dir, filename)
-        upload_template( local_file, remote_file, use_sudo=True, use_jinja=True, context={
+        context = {
             'PROJECT_NAME': PROJECT_NAME,
             'PG_VERSION_STRING': "%d.%d" % PG_VERSION,
-        })
-        sudo('chown %s:%s %s' % ('postgres', 'postgres', remote_file))
+            'listen_addresses': ','.join(['localhost'] + _listen_addresses(_database_clients())[1:]),
+            # IPs need a mask; names only work from Postgres 9.1 on
+            'client_addresses': [a if re.search('[^0-9.]', a) else a + '/32'
+                                 for a in _client_addresses(_database_clients()) if a != '127.0.0.1'],
+        }
+        context.update(tuning)
+        templates.append((local_file, remote_file, context))
+    changed = sync_templates(templates, owner='postgres:postgres')
     run_with_safe_error("createdb %s" % PROJECT_NAME, 'some dumb error', use_sudo=True, user='postgres')
     run_with_safe_error("""psql -c "create user %s with createdb encrypted password '%s'" """ % (PROJECT_NAME, DB_PASS), "some dumb error", use_sudo=True, user='postgres')
     sudo("""psql -c "grant all privileges on database %s to %s" """ % (PROJECT_NAME, PROJECT_NAME), user='postgres')
-
-def make_symlink_atomically(new_target, symlink_location, sudo=False):
+    return changed
+
+def configure_pooler():
+    """Returns the list of config files that changed."""
+    # pgbouncer's md5 format, which it can also log in to Postgres with
+    password_hash = 'md5' + hashlib.md5(DB_PASS + PROJECT_NAME).hexdigest()
+    userlist = '/etc/pgbouncer/userlist.txt'
+    changed = sync_templates([
+        ('./server/pooler/pgbouncer.ini', '/etc/pgbouncer/pgbouncer.ini', {
+            'PROJECT_NAME': PROJECT_NAME,
+            'POOLER_PORT': POOLER_PORT,
+            'POOL_SIZE': POOLER_POOL_SIZE,
+            'listen_addr': ','.join(_listen_addresses('django')),
+        }),
+        ('./server/pooler/userlist.txt', userlist, {
+            'PROJECT_NAME': PROJECT_NAME,
+            'password_hash': password_hash,
+        }),
+        ('./server/pooler/default', '/etc/default/pgbouncer', {}),
+    ], owner='postgres:postgres')
+    if userlist in changed:
+        sudo('chmod 640 %s' % userlist)
+    return changed
+
+def update_config():
+    """
+    Re-renders the config of the roles this host has (see _set_topology), and
+    reloads or restarts only the services whose config actually changed.
+    """
+    if _has_role('nginx') and configure_nginx():
+        reload_nginx()
+    if _has_role('django') and configure_django():
+        restart_django()
+    if _has_role('database'):
+        changed = configure_database()
+        if [f for f in changed if os.path.basename(f) not in PG_RELOADABLE_CONFIG]:
+            restart_database()
+        elif changed:
+            reload_database()
+    if USE_POOLER and _has_role('pooler') and configure_pooler():
+        reload_pooler()
+
+def make_symlink_atomically(new_target, symlink_location, use_sudo=False):
     # From http://blog.moertel.com/articles/2005/08/22/how-to-change-symlinks-atomically
-    runner = sudo if sudo else run
+    runner = sudo if use_sudo else run
     params = {
             'new_target': new_target,
             'symlink_location': symlink_location,
-            'tempname': 'current_tmp',
+            # Same directory as the symlink, so the mv is a rename
+            'tempname': symlink_location + '_tmp',
             }
     cmd = "ln -s %(new_target)s %(tempname)s && mv -Tf %(tempname)s %(symlink_location)s" % params
     runner(cmd)
@@ -380,6 +994,49 @@ def make_symlink_atomically(new_target, symlink_location, sudo=False):
 class Deploy(object):
 
     run_time = time.time()
+    timings = {} # host => [(phase, seconds, finished_at)] not saved yet
+    # These don't overlap, so they add up to the deploy's total. The other
+    # phases (processor, manage.py steps, ...) are parts of prep_release.
+    top_level_phases = ['upload_new_release', 'prep_release', 'candidate_check', 'switch_symlink',
+                        'restart_after_deploy', 'live_check']
+
+    @staticmethod
+    @contextmanager
+    def timed(phase):
+        """Times the block as a deploy phase; Deploy.save_timings writes it out."""
+        start = time.time()
+        yield
+        end = time.time()
+        Deploy.timings.setdefault(env.host_string, []).append((phase, round(end - start, 3), end))
+
+    @staticmethod
+    def save_timings(name):
+        """
+        Appends this host's timed phases to the release's timings.json.
+
+        Other steps (like manage.py prep_release) may have added their own
+        phases already, so the existing record is extended, not replaced.
+        """
+        phases = Deploy.timings.pop(env.host_string, [])
+        if not phases:
+            return
+        path = os.path.join(Deploy.get_release_dir(name), TIMINGS_FILENAME)
+        record = {'release': name, 'phases': []}
+        with settings(hide('stdout'), warn_only=True):
+            existing = run('cat %s' % path)
+        if not existing.failed:
+            try:
+                record = json.loads(existing)
+            except ValueError:
+                pass
+        record['host'] = env.host_string
+        for phase, seconds, finished_at in phases:
+            record['phases'].append({
+                'phase': phase,
+                'seconds': seconds,
+                'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(finished_at)),
+            })
+        put(StringIO(json.dumps(record, indent=2)), path)
 
     @staticmethod
     def get_current_commit():
@@ -400,6 +1057,89 @@ class Deploy(object):
         symlink_location = os.path.join(PROJECT_DIR, 'current')
         make_symlink_atomically(new_target, symlink_location)
 
+    @staticmethod
+    def get_current_release():
+        """Name of the release `current` points to, or None before the first deploy."""
+        with settings(hide('running', 'stdout'), warn_only=True):
+            target = run('readlink %s' % os.path.join(PROJECT_DIR, 'current'))
+        return os.path.basename(target.strip()) if target.succeeded and target.strip() else None
+
+    @staticmethod
+    def load_candidate(name):
+        """Points the candidate daemon (see server/django/vhost) at release `name` and restarts it."""
+        make_symlink_atomically(Deploy.get_release_dir(name), os.path.join(PROJECT_DIR, 'candidate'))
+        # mod_wsgi restarts a daemon process group when its script is touched
+        sudo('touch %s' % os.path.join(PROJECT_DIR, 'candidate_wsgi.py'))
+
+    @staticmethod
+    def check_release(port):
+        """
+        Warms up the Django on `port` with ACTIVATION_WARM_ROUNDS requests to
+        each of ACTIVATION_CHECK_URLS, then times ACTIVATION_CHECK_ROUNDS more.
+        Returns a list of problems; empty if every URL returned 200 within
+        ACTIVATION_MAX_SECONDS (median).
+        """
+        curl = ("echo %(url)s $(curl -s -o /dev/null -m 30 -H 'Host: %(host)s' "
+                "-w '%%{http_code} %%{time_total}' http://127.0.0.1:%(port)d%(url)s || true)")
+        cmds = []
+        for i in range(ACTIVATION_WARM_ROUNDS + ACTIVATION_CHECK_ROUNDS):
+            for url in ACTIVATION_CHECK_URLS:
+                cmds.append(curl % {'url': url, 'host': env.stage['hostname'], 'port': port})
+        with hide('running', 'stdout'):
+            output = run('\n'.join(cmds))
+        results = {} # url => [(status, seconds)], checked rounds only
+        lines = [line.split() for line in output.splitlines()]
+        lines = [parts for parts in lines if len(parts) == 3 and parts[0] in ACTIVATION_CHECK_URLS]
+        for url, status, seconds in lines[ACTIVATION_WARM_ROUNDS * len(ACTIVATION_CHECK_URLS):]:
+            results.setdefault(url, []).append((status, float(seconds)))
+        problems = []
+        for url in ACTIVATION_CHECK_URLS:
+            statuses = [status for status, seconds in results.get(url, [])]
+            times = sorted(seconds for status, seconds in results.get(url, []))
+            median = times[len(times) // 2] if times else 0
+            print '  %s: %s, median %.3fs' % (url, ' '.join(statuses), median)
+            if [status for status in statuses if status != '200']:
+                problems.append('%s returned %s' % (url, ', '.join(sorted(set(statuses)))))
+            elif median > ACTIVATION_MAX_SECONDS:
+                problems.append('%s took %.3fs (median), over %.3fs' % (url, median, ACTIVATION_MAX_SECONDS))
+        return problems
+
+    @staticmethod
+    def activate_checked(name):
+        """
+        ACTIVATION_MODE 'candidate': loads release `name` into the candidate
+        daemon and checks it before switching `current`, then checks again
+        once it's live and switches back if that fails.
+        """
+        previous = Deploy.get_current_release()
+        if not exists(os.path.join(PROJECT_DIR, 'candidate_wsgi.py')):
+            abort("This host has no candidate daemon yet. Run update_config to add it, "
+                  "or set ACTIVATION_MODE = 'graceful'.")
+        print 'Checking %s on the candidate port' % name
+        with Deploy.timed('candidate_check'):
+            Deploy.load_candidate(name)
+            problems = Deploy.check_release(CANDIDATE_PORT)
+        if problems:
+            Deploy.save_timings(name)
+            abort('Release %s failed its checks; %s is still live:\n  %s' % (name, previous, '\n  '.join(problems)))
+        with Deploy.timed('switch_symlink'):
+            Deploy.switch_symlink(name)
+        # New daemon processes preload the release (WSGIImportScript); old ones finish their requests
+        with Deploy.timed('restart_after_deploy'):
+            restart_after_deploy()
+        print 'Checking %s live' % name
+        with Deploy.timed('live_check'):
+            problems = Deploy.check_release(DJANGO_PORT)
+        Deploy.save_timings(name)
+        if problems and previous:
+            Deploy.switch_symlink(previous)
+            restart_after_deploy()
+            abort('Release %s failed its checks once live; rolled back to %s:\n  %s' % (
+                name, previous, '\n  '.join(problems)))
+        elif problems:
+            abort('Release %s failed its checks once live, with no release to roll back to:\n  %s' % (
+                name, '\n  '.join(problems)))
+
     @staticmethod
     def get_release_dir(name):
         assert name
@@ -409,6 +1149,117 @@ class Deploy(object):
     def get_git_repo():
         return GIT_CLONE_USERNAME + '@' + GIT_CLONE_PSEUDOHOST + ':' + GIT_CLONE_PATH
  
+    @staticmethod
+    def get_package_filename(name):
+        return "%s.tar.gz" % name
+
+    @staticmethod
+    def get_package_tree(name):
+        return "%s.tree" % name
+
+    @staticmethod
+    def build_package(name):
+        """
+        Builds the local release tarball (and, for rsync, its unpacked tree).
+
+        Only builds once per release name, so it is safe to call from each
+        host's upload. Parallel deploys call it up front to avoid racing.
+        """
+        if RELEASE_UPLOAD_MODE not in ('archive', 'rsync'):
+            return
+        pkg_filename = Deploy.get_package_filename(name)
+        if not os.path.exists(pkg_filename):
+            tmp_filename = pkg_filename + '.tmp'
+            local('git archive --format=tar %s | gzip > %s' % (Deploy.get_current_commit(), tmp_filename))
+            local('mv %s %s' % (tmp_filename, pkg_filename))
+        tree = Deploy.get_package_tree(name)
+        if RELEASE_UPLOAD_MODE == 'rsync' and not os.path.exists(tree):
+            tmp_tree = tree + '.tmp'
+            local('rm -rf %s && mkdir %s' % (tmp_tree, tmp_tree))
+            local('tar -xzf %s -C %s' % (pkg_filename, tmp_tree))
+            local('echo %s > %s' % (Deploy.get_current_commit(), os.path.join(tmp_tree, 'REVISION')))
+            local('mv %s %s' % (tmp_tree, tree))
+
+    @staticmethod
+    def clone_release(name):
+        release_dir = Deploy.get_release_dir(name)
+        run('git clone %s %s' % (Deploy.get_git_repo(), release_dir))
+        current_commit = Deploy.get_current_commit()
+        with cd(release_dir):
+            run('git reset --hard %s' % current_commit)
+
+    @staticmethod
+    def get_git_mirror():
+        return os.path.join(PROJECT_DIR, 'packages', PROJECT_NAME + '.git')
+
+    @staticmethod
+    def update_git_mirror():
+        """Creates the server's bare mirror of the repo, or fetches what's new."""
+        mirror = Deploy.get_git_mirror()
+        if exists(os.path.join(mirror, 'HEAD')):
+            run('git --git-dir=%s remote update --prune' % mirror)
+        else:
+            run('git clone --mirror %s %s' % (Deploy.get_git_repo(), mirror))
+            # Releases borrow objects from the mirror, so it must never prune them
+            run('git --git-dir=%s config gc.pruneexpire never' % mirror)
+
+    @staticmethod
+    def mirror_release(name):
+        """
+        Clones a release from the local mirror.
+
+        --shared makes the release use the mirror's objects via alternates
+        instead of copying them, so only the checkout itself costs disk.
+        """
+        Deploy.update_git_mirror()
+        release_dir = Deploy.get_release_dir(name)
+        run('git clone --shared --no-checkout %s %s' % (Deploy.get_git_mirror(), release_dir))
+        current_commit = Deploy.get_current_commit()
+        with cd(release_dir):
+            run('git reset --hard %s' % current_commit)
+
+    @staticmethod
+    def upload_package(name):
+        release_dir = Deploy.get_release_dir(name)
+        pkg_filename = Deploy.get_package_filename(name)
+        remote_pkg = os.path.join(PROJECT_DIR, 'packages', pkg_filename)
+        put(pkg_filename, remote_pkg)
+        run('mkdir -p %s && tar -xzf %s -C %s && rm %s && echo %s > %s' % (
+            release_dir, remote_pkg, release_dir, remote_pkg,
+            Deploy.get_current_commit(), os.path.join(release_dir, 'REVISION')))
+
+    @staticmethod
+    def rsync_release(name):
+        """
+        Sends only the files that changed since the `current` release.
+
+        Unchanged files are hardlinked from `current`, so they cost neither
+        bandwidth nor disk. Nothing may modify release files in place
+        afterwards, or the change shows up in `current` too.
+        """
+        release_dir = Deploy.get_release_dir(name)
+        with settings(warn_only=True):
+            previous = run('readlink -e %s' % os.path.join(PROJECT_DIR, 'current'))
+        # --link-dest only links files whose permissions match too, and
+        # set_up_permissions makes everything in `current` g+w
+        opts = '-rlpcz --chmod=g+w --delete'
+        if not previous.failed and previous.strip():
+            opts += ' --link-dest=%s' % previous.strip()
+        user, host, port = normalize(env.host_string)
+        ssh = 'ssh -p %s %s' % (port, SSH_MULTIPLEX_OPTS)
+        if env.key_filename:
+            key_filenames = env.key_filename
+            if isinstance(key_filenames, basestring):
+                key_filenames = [key_filenames]
+            ssh += ''.join(' -i %s' % k for k in key_filenames)
+        run('mkdir -p %s' % release_dir)
+        local('rsync %s -e "%s" %s/ %s@%s:%s/' % (opts, ssh, Deploy.get_package_tree(name), user, host, release_dir))
+        if '--link-dest' in opts:
+            with hide('running', 'stdout'):
+                counts = run('find %s -type f | wc -l; find %s -type f -links +1 | wc -l' % (release_dir, release_dir))
+            total, linked = counts.split()[-2:]
+            print 'Hardlinked %s of %s files from %s' % (linked, total, previous.strip())
+
     @staticmethod
     def upload_new_release():
         name = Deploy.get_release_name()
@@ -416,46 +1267,60 @@ class Deploy(object):
         if exists(release_dir):
             assert release_dir.startswith(os.path.join(PROJECT_DIR, 'releases'))
             run('rm -rf %s' % release_dir)
-        run('git clone %s %s' % (Deploy.get_git_repo(), release_dir))
+        Deploy.build_package(name)
+        uploader = {
+            'clone': Deploy.clone_release,
+            'mirror': Deploy.mirror_release,
+            'archive': Deploy.upload_package,
+            'rsync': Deploy.rsync_release,
+        }[RELEASE_UPLOAD_MODE]
+        uploader(name)
         set_up_permissions(release_dir)
-        current_commit = Deploy.get_current_commit()
-        with cd(release_dir):
-            run('git reset --hard %s' % current_commit)
         return name
 
     @staticmethod
-    def prep_release(name):
-        """Prepares all the files in the release dir."""
+    def prep_release(name, steps=None):
+        """
+        Prepares all the files in the release dir. `steps` limits which of
+        manage.py prep_release's steps run, e.g. 'templates,collectstatic'.
+        """
         assert name
         release_dir = Deploy.get_release_dir(name)
         django_dir = os.path.join(release_dir, PROJECT_NAME)
-        # If you run a preprocessor, like JS/CSS compilation, do that here, e.g. :
-        #run(os.path.join(PROJECT_DIR, 'bin', 'processor') + ' ' + release_dir)
+        print 'Processing JS/CSS'
+        with Deploy.timed('processor'):
+            # Bundles and precompresses assets; see server/processor/processor
+            run('python %s --cache-dir=%s %s' % (os.path.join(release_dir, 'server', 'processor', 'processor'),
+                os.path.join(PROJECT_DIR, 'packages', 'processor_cache'), release_dir))
         print 'Setting up Django settings symlinks'
         with cd(django_dir):
-            run('ln -nfs %s .' % os.path.join(PROJECT_DIR, 'stagesettings.py'))
-            run('ln -nfs %s .' % os.path.join(PROJECT_DIR, 'localsettings.py'))
+            run('ln -nfs %s %s .' % (os.path.join(PROJECT_DIR, 'stagesettings.py'), os.path.join(PROJECT_DIR, 'localsettings.py')))
 
-        print 'Doing Django database updates'
+        print 'Doing Django database and static updates'
         with cd(django_dir):
             with_ve =  'source ' + os.path.join(VIRTUALENV, 'bin', 'activate') + ' && '
-            run(with_ve + 'python manage.py syncdb --noinput')
-            run(with_ve + 'python manage.py migrate --noinput')
-            run(with_ve + 'python manage.py loaddata initial_data')
-            run(with_ve + 'python manage.py collectstatic --noinput')
-            
+            # Skips the steps whose inputs match those of the `current` release.
+            # Records its own per-step timings in timings.json.
+            with Deploy.timed('manage.py prep_release'):
+                run(with_ve + 'python manage.py prep_release --previous=%s --static-store=%s%s' % (
+                    os.path.join(PROJECT_DIR, 'current'), os.path.join(PROJECT_DIR, 'static_store'),
+                    ' --steps=%s' % steps if steps else ''))
 
         print 'Installing crontab'
         crontab_path = os.path.join(release_dir, 'server/crontab')
         # need to use the stdin formulation. For some reason the path in the normal form
         # gets truncated.
-        run('crontab - < %s' % crontab_path)
+        with Deploy.timed('crontab'):
+            run('crontab - < %s' % crontab_path)
 
     @staticmethod
     def cleanup_release(name):
-        pkg_filename = "%s.tar.gz" % name
+        pkg_filename = Deploy.get_package_filename(name)
         if os.path.exists(pkg_filename):
             local('rm %s' % pkg_filename)
+        tree = Deploy.get_package_tree(name)
+        if os.path.exists(tree):
+            local('rm -rf %s' % tree)
 
 
 def list_releases():
@@ -463,48 +1328,374 @@ def list_releases():
         run('''ls -ltc | grep -v total | awk '{print $6 " " $7 " " $8 " " $9}' | head -n 10''')
         #run('ls -l %s | cut -d " " -f "10"' % os.path.join(PROJECT_DIR, CURRENT_RELEASE_DIR))
 
+def list_release_timings(count=10):
+    """
+    Like list_releases, but with how long each deploy phase took, and how
+    the newest release compares to the median of the ones before it.
+    """
+    releases_dir = os.path.join(PROJECT_DIR, 'releases')
+    with hide('stdout'):
+        output = run('for f in $(ls -1t %s | head -n %d); do echo "== $f"; cat %s/$f/%s 2>/dev/null; echo; done' % (
+            releases_dir, int(count), releases_dir, TIMINGS_FILENAME))
+    records = []
+    for chunk in output.split('== ')[1:]:
+        name, _, body = chunk.partition('\n')
+        try:
+            record = json.loads(body)
+        except ValueError:
+            continue # Released before timings were recorded
+        times = {}
+        for p in record['phases']:
+            times[p['phase']] = times.get(p['phase'], 0) + p['seconds']
+        records.append((name.strip(), times))
+    if not records:
+        print 'No timings recorded yet'
+        return
+    phases = []
+    for name, times in records:
+        phases.extend(sorted(p for p in times if p not in phases))
+    print ' | '.join(['release'.ljust(len(records[0][0])), 'total'] + phases)
+    for name, times in records:
+        row = [name, ('%.1f' % sum(times.get(p, 0) for p in Deploy.top_level_phases)).rjust(len('total'))]
+        row += [('%.1f' % times[p] if p in times else '-').rjust(len(p)) for p in phases]
+        print ' | '.join(row)
+    if len(records) < 2:
+        return
+    print
+    print 'Newest vs median of the %d before it:' % (len(records) - 1)
+    for phase in phases:
+        previous = sorted(times[phase] for name, times in records[1:] if phase in times)
+        if phase not in records[0][1] or not previous:
+            continue
+        median = previous[len(previous) // 2]
+        latest = records[0][1][phase]
+        change = '%+.0f%%' % ((latest - median) * 100 / median) if median else 'n/a'
+        print '  %s: %.1fs (median %.1fs, %s)' % (phase, latest, median, change)
+
+class Benchmark(object):
+    """
+    A small HTTP load generator and the records of its runs. Each of
+    `concurrency` threads keeps one connection open and goes round the URL
+    mix, so every run requests the same paths in the same proportions.
+    """
+    @staticmethod
+    def parse_urls(spec):
+        """'/*3;/about' => [('/', 3), ('/about', 1)]"""
+        urls = []
+        for part in spec.split(';'):
+            path, _, weight = part.strip().partition('*')
+            if path:
+                urls.append((path, int(weight or 1)))
+        return urls
+
+    @staticmethod
+    def load(base_url, urls, concurrency, seconds, warmup_seconds=0):
+        """
+        Requests base_url + each path for warmup_seconds, then for `seconds`
+        more. Returns (path, status, seconds) for each request started after
+        the warmup; status is None if the request failed.
+        """
+        parsed = urlparse.urlparse(base_url)
+        connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+        prefix = parsed.path.rstrip('/')
+        paths = [path for path, weight in urls for i in range(weight)]
+        measure_from = time.time() + warmup_seconds
+        deadline = measure_from + seconds
+        samples = []
+        def client(offset):
+            conn = connection_class(parsed.netloc, timeout=30)
+            mine = []
+            for i in xrange(offset, sys.maxint):
+                started = time.time()
+                if started >= deadline:
+                    break
+                path = paths[i % len(paths)]
+                try:
+                    conn.request('GET', prefix + path, headers=BENCHMARK_HEADERS)
+                    response = conn.getresponse()
+                    response.read()
+                    status = response.status
+                except (httplib.HTTPException, socket.error):
+                    conn.close() # Reconnects on the next request
+                    status = None
+                if started >= measure_from:
+                    mine.append((path, status, time.time() - started))
+            conn.close()
+            samples.extend(mine)
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return samples
+
+    @staticmethod
+    def summarize(samples, seconds):
+        """Request and error counts, throughput, and p50/p95/p99 in ms; overall and per path."""
+        def stats(samples):
+            times = sorted(t for path, status, t in samples if status is not None)
+            result = {
+                'requests': len(samples),
+                'errors': len([1 for path, status, t in samples if status is None or status >= 400]),
+                'rps': round(len(samples) / seconds, 1),
+            }
+            for pct in (50, 95, 99):
+                # Nearest rank
+                index = max(0, int(math.ceil(pct / 100.0 * len(times))) - 1)
+                result['p%d_ms' % pct] = round(times[index] * 1000, 1) if times else None
+            return result
+        by_path = {}
+        for sample in samples:
+            by_path.setdefault(sample[0], []).append(sample)
+        return {
+            'overall': stats(samples),
+            'urls': dict((path, stats(s)) for path, s in by_path.items()),
+        }
+
+    @staticmethod
+    def compare(result, previous):
+        """Returns a list of ways `result` is worse than `previous`, another run."""
+        regressions = []
+        pairs = [('overall', result['overall'], previous['overall'])]
+        pairs += [(path, result['urls'][path], previous['urls'][path])
+                  for path in sorted(result['urls']) if path in previous['urls']]
+        for label, now, before in pairs:
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                if now[key] is None or not before[key]:
+                    continue
+                if (now[key] > before[key] * (1 + BENCHMARK_MAX_SLOWDOWN)
+                        and now[key] - before[key] >= BENCHMARK_MIN_SLOWDOWN_MS):
+                    regressions.append('%s %s: %.1fms, was %.1fms (%+.0f%%)' % (
+                        label, key[:3], now[key], before[key], (now[key] - before[key]) * 100 / before[key]))
+            error_rate = float(now['errors']) / max(now['requests'], 1)
+            before_error_rate = float(before['errors']) / max(before['requests'], 1)
+            if now['errors'] and error_rate > before_error_rate:
+                regressions.append('%s errors: %.1f%%, was %.1f%%' % (label, error_rate * 100, before_error_rate * 100))
+        if result['overall']['rps'] < previous['overall']['rps'] * (1 - BENCHMARK_MAX_SLOWDOWN):
+            regressions.append('throughput: %.1f requests/s, was %.1f' % (
+                result['overall']['rps'], previous['overall']['rps']))
+        return regressions
+
+    @staticmethod
+    def print_summary(result):
+        print '  %s | requests | errors | req/s |    p50 |    p95 |    p99' % 'url'.ljust(30)
+        rows = [('(all)', result['overall'])] + sorted(result['urls'].items())
+        for label, stats in rows:
+            print '  %s | %8d | %6d | %5.1f | %s | %s | %s' % ((label.ljust(30), stats['requests'], stats['errors'], stats['rps'])
+                + tuple(('%.1fms' % stats[key] if stats[key] is not None else '-').rjust(6)
+                        for key in ('p50_ms', 'p95_ms', 'p99_ms')))
+
+    # Records are kept in the release dir on a django host (remote=True), or
+    # under BENCHMARKS_DIR locally. Either way they hold a list of runs.
+
+    @staticmethod
+    def get_record_path(name, remote):
+        if remote:
+            return os.path.join(Deploy.get_release_dir(name), BENCHMARKS_FILENAME)
+        return os.path.join(BENCHMARKS_DIR, name + '.json')
+
+    @staticmethod
+    def get_recorded_releases(remote):
+        """Names of the releases with records, oldest first."""
+        if remote:
+            with settings(hide('running', 'stdout'), warn_only=True):
+                output = run('cd %s && ls -1 */%s' % (os.path.join(PROJECT_DIR, 'releases'), BENCHMARKS_FILENAME))
+            names = [line.strip().split('/')[0] for line in output.splitlines()
+                     if line.strip().endswith('/' + BENCHMARKS_FILENAME)]
+        elif os.path.isdir(BENCHMARKS_DIR):
+            names = [f[:-len('.json')] for f in os.listdir(BENCHMARKS_DIR) if f.endswith('.json')]
+        else:
+            names = []
+        # Release names start with the time they were made
+        return sorted(names)
+
+    @staticmethod
+    def load_record(name, remote):
+        path = Benchmark.get_record_path(name, remote)
+        if remote:
+            with settings(hide('running', 'stdout'), warn_only=True):
+                text = run('cat %s' % path)
+            if text.failed:
+                return None
+        elif os.path.exists(path):
+            with open(path) as f:
+                text = f.read()
+        else:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def save_record(name, record, remote):
+        text = json.dumps(record, indent=2)
+        path = Benchmark.get_record_path(name, remote)
+        if remote:
+            put(StringIO(text), path)
+        else:
+            if not os.path.isdir(BENCHMARKS_DIR):
+                os.makedirs(BENCHMARKS_DIR)
+            with open(path, 'w') as f:
+                f.write(text)
+
+@runs_once
+def benchmark_release(base_url=None, concurrency=BENCHMARK_CONCURRENCY, seconds=BENCHMARK_SECONDS,
+                      urls=None, fail_on_regression=False):
+    """
+    Load-tests the live release, records latency and throughput, and compares
+    them with the last run against the release before it.
+
+    With a stage, requests go to its hostname, and the run is recorded in the
+    current release's dir on the first django host. Without one, e.g.
+    "fab benchmark_release:base_url=http://127.0.0.1:8000" against runserver,
+    it's recorded under BENCHMARKS_DIR by Deploy.get_release_name().
+
+    urls replaces BENCHMARK_URLS, e.g. "/*3;/about". With fail_on_regression,
+    regressions fail the task as well as being listed.
+    """
+    remote = 'stage' in env
+    if not base_url:
+        if not remote:
+            abort('Pick a stage, or give base_url')
+        base_url = 'http://' + env.stage['hostname']
+    url_mix = Benchmark.parse_urls(urls) if urls else BENCHMARK_URLS
+    concurrency, seconds = int(concurrency), float(seconds)
+    if remote:
+        host = env.roledefs['django'][0]
+        with settings(host_string=host):
+            name = Deploy.get_current_release()
+        if not name:
+            abort('Nothing is deployed on %s yet' % host)
+    else:
+        host = None
+        name = Deploy.get_release_name()
+
+    print 'Benchmarking %s at %s: %d clients for %ds, after %ds warming up' % (
+        name, base_url, concurrency, seconds, BENCHMARK_WARMUP_SECONDS)
+    samples = Benchmark.load(base_url, url_mix, concurrency, seconds, BENCHMARK_WARMUP_SECONDS)
+    if not samples:
+        abort('No requests finished')
+    result = Benchmark.summarize(samples, seconds)
+    result.update({
+        'base_url': base_url,
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'url_mix': [list(url) for url in url_mix], # As JSON has it
+        'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    Benchmark.print_summary(result)
+
+    with settings(host_string=host):
+        record = Benchmark.load_record(name, remote) or {'release': name, 'runs': []}
+        record['runs'].append(result)
+        Benchmark.save_record(name, record, remote)
+        earlier = [n for n in Benchmark.get_recorded_releases(remote) if n < name]
+        previous = earlier and Benchmark.load_record(earlier[-1], remote)
+    if not previous or not previous['runs']:
+        print 'No earlier release has been benchmarked; nothing to compare with'
+        return
+    before = previous['runs'][-1]
+    print
+    print 'Compared with %s:' % previous['release']
+    if [key for key in ('base_url', 'concurrency', 'url_mix') if before.get(key) != result[key]]:
+        print '  (that run used other settings, so the numbers may not be comparable)'
+    regressions = Benchmark.compare(result, before)
+    for regression in regressions:
+        print '  REGRESSION %s' % regression
+    if not regressions:
+        print '  No regressions'
+    elif fail_on_regression:
+        abort('%s is slower than %s' % (name, previous['release']))
+
 # Two-step Deploy; use this for HA multi-server setup:
 # 1. deploy_prep_new_release
 # 2. deploy_activate_release:<release_name>
 
+def _prep_new_release(steps=None):
+    with Deploy.timed('upload_new_release'):
+        release_name = Deploy.upload_new_release()
+    with Deploy.timed('prep_release'):
+        Deploy.prep_release(release_name, steps)
+    Deploy.save_timings(release_name)
+    return release_name
+
+@roles('django')
 def deploy_prep_new_release():
     local('git push')
-    release_name = Deploy.upload_new_release()
-    Deploy.prep_release(release_name)
+    release_name = _prep_new_release()
     print '*'*20
     print "Prepped new release", release_name
     print 'You probably want to deploy_activate_release:%s' % release_name
     print '*'*20
 
+@runs_once
+def parallel_deploy_prep_new_release(pool_size=None):
+    """
+    Like deploy_prep_new_release, but on all hosts at once. The database is
+    shared, so syncdb, migrate and loaddata only run on the first host,
+    before the others start; those only check templates and collect static.
+    """
+    local('git push')
+    release_name = Deploy.get_release_name()
+    Deploy.build_package(release_name)
+    hosts = env.roledefs['django']
+    with settings(host_string=hosts[0]):
+        _prep_new_release()
+    failures = {}
+    if hosts[1:]:
+        failures = Parallel.execute(_prep_new_release, 'templates,collectstatic', hosts=hosts[1:], pool_size=pool_size)
+    if failures:
+        abort('Prepping %s failed on: %s' % (release_name, ', '.join(sorted(failures))))
+    print "Prepped new release", release_name, "on", ', '.join(hosts)
+    print 'You probably want to parallel:deploy_activate_release,%s' % release_name
+    print '*'*20
+
+@roles('django')
 def deploy_activate_release(release_name):
+    """Puts a prepped release live; see ACTIVATION_MODE."""
     assert release_name
-    Deploy.switch_symlink(release_name)
-    restart_after_deploy()
+    # The first release has nothing to fall back to, and may be deployed before Apache runs
+    if ACTIVATION_MODE == 'candidate' and Deploy.get_current_release():
+        Deploy.activate_checked(release_name)
+    else:
+        with Deploy.timed('switch_symlink'):
+            Deploy.switch_symlink(release_name)
+        with Deploy.timed('restart_after_deploy'):
+            restart_after_deploy()
+        Deploy.save_timings(release_name)
     Deploy.cleanup_release(release_name)
 
 # One-step Deploy; use this for one-server setup or if lazy
 # 1. simple_deploy
 
+@roles('django')
 def deploy():
-    release_name = Deploy.upload_new_release()
-    Deploy.prep_release(release_name)
-    Deploy.switch_symlink(release_name)
+    with Deploy.timed('upload_new_release'):
+        release_name = Deploy.upload_new_release()
+    with Deploy.timed('prep_release'):
+        Deploy.prep_release(release_name)
+    with Deploy.timed('switch_symlink'):
+        Deploy.switch_symlink(release_name)
+    Deploy.save_timings(release_name)
     Deploy.cleanup_release(release_name)
+    return release_name
 
 def restart_after_deploy():
     restart_django()
 
+@roles('django')
 def simple_deploy():
     local('git push')
-    deploy()
-    restart_after_deploy()
+    release_name = _prep_new_release()
+    deploy_activate_release(release_name)
 
 # 
 # Service control
 # 
 
 def reload_nginx():
-    sudo('initctl reload nginx')
+    sudo('/etc/init.d/nginx reload')
 
 def reload_django():
     sudo('apache2ctl graceful')
@@ -515,6 +1706,9 @@ def reload_database():
     else:
         sudo('/etc/init.d/postgresql reload')
 
+def reload_pooler():
+    sudo('/etc/init.d/pgbouncer reload')
+
 def restart_nginx():
     sudo('/etc/init.d/nginx restart')
 
@@ -527,5 +1721,8 @@ def restart_database():
     else:
         sudo('/etc/init.d/postgresql restart || /etc/init.d/postgresql start')
 
+def restart_pooler():
+    sudo('/etc/init.d/pgbouncer restart || /etc/init.d/pgbouncer start')
+
 def restart_smtp():
     sudo('/etc/init.d/postfix restart')
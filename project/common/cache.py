@@ -0,0 +1,191 @@
+"""
+Cache backend that keeps a small LRU inside each process in front of
+memcached. Use it in settings.CACHES:
+
+    'BACKEND': 'common.cache.TwoTierCache',
+    'OPTIONS': {'LOCAL_TIMEOUT': 5, 'LOCAL_MAX_BYTES': 16*1024*1024},
+
+Values are kept in the local tier for at most LOCAL_TIMEOUT seconds, so a
+write from another process can go unseen for that long. Writes made through
+this process update or drop the local copy right away.
+"""
+import cPickle as pickle
+import threading
+import time
+
+from django.core.cache.backends.memcached import MemcachedCache
+
+from common import metrics
+
+class LocalLRU(object):
+    """
+    Thread-safe LRU of pickled values, bounded by their total size in bytes.
+    Values bigger than max_item_bytes aren't kept.
+
+    Items are kept in a circular doubly linked list, most recently used last,
+    with a dict pointing at the links (collections.OrderedDict needs 2.7).
+    """
+    PREV, NEXT, KEY, EXPIRES_AT, PICKLED = range(5)
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+        del self._links[link[self.KEY]]
+        self.bytes -= len(link[self.PICKLED])
+
+    def _append(self, link):
+        last = self._root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, self._root
+        last[self.NEXT] = self._root[self.PREV] = link
+        self._links[link[self.KEY]] = link
+        self.bytes += len(link[self.PICKLED])
+
+    def get(self, key, now):
+        """Returns the pickled value, or None."""
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                return None
+            self._unlink(link)
+            if link[self.EXPIRES_AT] <= now:
+                return None
+            self._append(link) # Back to the most recent end
+            return link[self.PICKLED]
+
+    def set(self, key, pickled, expires_at):
+        with self._lock:
+            old = self._links.get(key)
+            if old is not None:
+                self._unlink(old)
+            if len(pickled) > self.max_item_bytes:
+                return
+            self._append([None, None, key, expires_at, pickled])
+            while self.bytes > self.max_bytes:
+                self._unlink(self._root[self.NEXT])
+
+    def delete(self, key):
+        with self._lock:
+            old = self._links.get(key)
+            if old is not None:
+                self._unlink(old)
+
+    def clear(self):
+        with self._lock:
+            self._root = root = []
+            root[:] = [root, root, None, None, '']
+            self._links = {} # key -> link
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._links)
+
+class TwoTierCache(MemcachedCache):
+    """
+    MemcachedCache with a per-process LocalLRU in front. Hits and misses are
+    counted per tier in `stats`, and per request in common.metrics.
+    """
+    def __init__(self, server, params):
+        super(TwoTierCache, self).__init__(server, params)
+        options = params.get('OPTIONS') or {}
+        self.local_timeout = int(options.get('LOCAL_TIMEOUT', 5))
+        self.local = LocalLRU(int(options.get('LOCAL_MAX_BYTES', 16*1024*1024)),
+                              int(options.get('LOCAL_MAX_ITEM_BYTES', 256*1024)))
+        self.stats = {
+            'local': {'hits': 0, 'misses': 0},
+            'memcached': {'hits': 0, 'misses': 0},
+        }
+
+    def _keep_local(self, key, value, timeout, now):
+        if value is None:
+            return # memcached can't tell a stored None from a miss either
+        timeout = min(self.local_timeout, timeout or self.default_timeout)
+        self.local.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + timeout)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        now = time.time()
+        pickled = self.local.get(key, now)
+        if pickled is not None:
+            self.stats['local']['hits'] += 1
+            metrics.count_cache(1, 0)
+            # A fresh copy, so callers can't change what other callers get
+            return pickle.loads(pickled)
+        self.stats['local']['misses'] += 1
+        value = self._cache.get(key)
+        if value is None:
+            self.stats['memcached']['misses'] += 1
+            metrics.count_cache(0, 1)
+            return default
+        self.stats['memcached']['hits'] += 1
+        metrics.count_cache(1, 0)
+        self._keep_local(key, value, self.local_timeout, now)
+        return value
+
+    def get_many(self, keys, version=None):
+        """Answers what it can locally, then asks memcached for the rest at once."""
+        now = time.time()
+        found = {}
+        remote = {}
+        for key in keys:
+            made_key = self.make_key(key, version=version)
+            pickled = self.local.get(made_key, now)
+            if pickled is not None:
+                found[key] = pickle.loads(pickled)
+            else:
+                remote[made_key] = key
+        self.stats['local']['hits'] += len(found)
+        self.stats['local']['misses'] += len(remote)
+        metrics.count_cache(len(found), 0)
+        if remote:
+            values = self._cache.get_multi(remote.keys()) or {}
+            self.stats['memcached']['hits'] += len(values)
+            self.stats['memcached']['misses'] += len(remote) - len(values)
+            metrics.count_cache(len(values), len(remote) - len(values))
+            for made_key, value in values.items():
+                self._keep_local(made_key, value, self.local_timeout, now)
+                found[remote[made_key]] = value
+        return found
+
+    def set(self, key, value, timeout=0, version=None):
+        super(TwoTierCache, self).set(key, value, timeout, version=version)
+        self._keep_local(self.make_key(key, version=version), value, timeout, time.time())
+
+    def set_many(self, data, timeout=0, version=None):
+        super(TwoTierCache, self).set_many(data, timeout, version=version)
+        now = time.time()
+        for key, value in data.items():
+            self._keep_local(self.make_key(key, version=version), value, timeout, now)
+
+    # Everything else changes the value in ways only memcached knows the
+    # result of, so the local copy is dropped.
+
+    def add(self, key, value, timeout=0, version=None):
+        self.local.delete(self.make_key(key, version=version))
+        return super(TwoTierCache, self).add(key, value, timeout, version=version)
+
+    def delete(self, key, version=None):
+        self.local.delete(self.make_key(key, version=version))
+        super(TwoTierCache, self).delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self.local.delete(self.make_key(key, version=version))
+        super(TwoTierCache, self).delete_many(keys, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self.local.delete(self.make_key(key, version=version))
+        return super(TwoTierCache, self).incr(key, delta, version=version)
+
+    def decr(self, key, delta=1, version=None):
+        self.local.delete(self.make_key(key, version=version))
+        return super(TwoTierCache, self).decr(key, delta, version=version)
+
+    def clear(self):
+        self.local.clear()
+        super(TwoTierCache, self).clear()
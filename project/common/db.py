@@ -0,0 +1,94 @@
+"""
+Persistent database connections. Django closes every connection at the end
+of each request; with settings.PERSISTENT_DB_CONNECTIONS, each worker
+thread keeps its connections open instead, so requests don't pay for
+connecting.
+
+Kept connections are checked with a "SELECT 1" at the start of a request if
+they've been idle for DB_HEALTH_CHECK_INTERVAL seconds, and closed once
+they're DB_CONNECTION_MAX_AGE seconds old. Django reconnects on the next
+query after a close.
+"""
+import time
+
+from django.conf import settings
+from django.core import signals
+from django.db import close_connection, connections
+
+def check_connections(**kwargs):
+    """request_started handler: drops connections that are too old or broken."""
+    now = time.time()
+    for conn in connections.all():
+        if conn.connection is None:
+            continue
+        # Attributes on the wrapper are per thread, like the connection itself
+        if getattr(conn, '_persistent_connection', None) is not conn.connection:
+            conn._persistent_connection = conn.connection
+            conn._opened_at = conn._checked_at = now
+            continue
+        if now - conn._opened_at > settings.DB_CONNECTION_MAX_AGE:
+            conn.close()
+        elif now - conn._checked_at > settings.DB_HEALTH_CHECK_INTERVAL:
+            try:
+                cursor = conn.connection.cursor()
+                cursor.execute('SELECT 1')
+                conn.connection.rollback()
+                conn._checked_at = now
+            except Exception:
+                conn.close()
+
+def end_transactions(**kwargs):
+    """
+    request_finished handler: ends whatever transaction a request left open
+    (e.g. one only reads), instead of closing the connection. An idle
+    transaction would otherwise hold on to a pooler's server connection.
+
+    Django runs "SET TIME ZONE" in a new connection's first transaction, so
+    this rolls it back. postgresql.conf sets the same timezone instead.
+    """
+    for conn in connections.all():
+        if conn.connection is None:
+            continue
+        try:
+            conn.connection.rollback()
+            conn._checked_at = time.time()
+        except Exception:
+            conn.close()
+
+def end_request():
+    """
+    Does to connections what request_finished does: closes them, or with
+    persistent connections, ends their transactions. For code that runs
+    after request_finished, like a streamed response's body.
+    """
+    if getattr(settings, 'PERSISTENT_DB_CONNECTIONS', False):
+        end_transactions()
+    else:
+        close_connection()
+
+def chunked_iterator(queryset, chunk_size=1000):
+    """
+    Iterates over queryset in primary key order, fetching chunk_size rows
+    at a time. queryset.iterator() alone doesn't save memory on Postgres:
+    psycopg2 fetches the whole result when the query runs. values()
+    querysets work too, if they include the primary key.
+    """
+    pk_name = queryset.model._meta.pk.name
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][pk_name] if isinstance(rows[-1], dict) else rows[-1].pk
+
+def setup_persistent_connections():
+    """Call once per process, e.g. from urls.py."""
+    if not getattr(settings, 'PERSISTENT_DB_CONNECTIONS', False):
+        return
+    signals.request_finished.disconnect(close_connection)
+    signals.request_finished.connect(end_transactions, dispatch_uid='common.db.end_transactions')
+    signals.request_started.connect(check_connections, dispatch_uid='common.db.check_connections')
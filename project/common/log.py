@@ -1,4 +1,5 @@
 import os, logging, logging.handlers, time
+import atexit, datetime, errno, glob, json, Queue, re, threading
 
 from django.conf import settings
 
@@ -29,26 +30,224 @@ _mkdir(settings.LOG_DIRECTORY)
 # files have g+w.)
 filename = settings.LOG_DIRECTORY + '/django_%s.log' % os.getuid()
 
-def convert_log_args(f):
-    """Makes logger functions act right."""
+def jsonl_filename(pid):
+    # One file per process as well, so no two processes ever write or rotate
+    # the same file. See the merge_logs command for reading them together.
+    return settings.LOG_DIRECTORY + '/django_%s_%s.jsonl' % (os.getuid(), pid)
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM # Someone else's process
+    return True
+
+def prune_jsonl_files(max_age_days):
+    """
+    Deletes this user's per-process logs, rotated copies included, whose
+    process has exited and that haven't been written to in max_age_days.
+    mod_wsgi replaces its processes often, so they'd pile up otherwise.
+    """
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    for path in glob.glob(jsonl_filename('*') + '*'):
+        match = re.match(r'django_\d+_(\d+)\.jsonl', os.path.basename(path))
+        if not match or _is_running(int(match.group(1))):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass # Another process pruned it first
+
+class LazyMessage(object):
+    """
+    Log message that joins its args only when a handler formats the record,
+    so args of records nobody writes are never stringified.
+    """
+    __slots__ = ['args']
+
+    def __init__(self, args):
+        self.args = args
+
+    def __unicode__(self):
+        return u', '.join(unicode(a) for a in self.args)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+def convert_log_args(f, level):
+    """
+    Makes logger functions act right: f(a, b) logs "a, b".
+
+    Returns before building anything if `level` isn't enabled, so disabled
+    calls in hot paths cost next to nothing.
+    """
     from functools import wraps
+    is_enabled = f.__self__.isEnabledFor
     @wraps(f)
     def new_f(*args):
-        return f(', '.join(unicode(a) for a in args))
+        if is_enabled(level):
+            f(LazyMessage(args))
     return new_f
 
+class QueueHandler(logging.Handler):
+    """
+    Hands records to a background thread, which writes them to `target` (a
+    RotatingFileHandler) in batches, so logging never waits on the disk.
+
+    The queue is bounded: when it's full, records are dropped and counted
+    in `dropped`, and the writer logs a warning saying how many were lost.
+    Whatever is still queued when the process exits gets written out.
+
+    A forked child doesn't get the writer thread, so it starts its own, with
+    a fresh queue, the first time it logs.
+    """
+    _stop = object()
+
+    def __init__(self, target, maxsize=10000, batch_size=500):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self._start_writer()
+        atexit.register(self.close)
+
+    def _start_writer(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.maxsize)
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._thread = threading.Thread(target=self._write, name='common.log writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def emit(self, record):
+        # Handler.handle holds self.lock around this, so only one thread restarts
+        if os.getpid() != self.pid:
+            # The parent's writer may have held this at the fork
+            self.target.createLock()
+            self._start_writer()
+        # Render in the caller's thread: args may be mutated after we return,
+        # and a traceback can't be formatted once the exception is gone.
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1 # Not exact under contention; good enough to alert on
+
+    def _write(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = self._stop in batch
+            batch = [r for r in batch if r is not self._stop]
+            if self.dropped != self._reported_dropped:
+                count = self.dropped - self._reported_dropped
+                self._reported_dropped += count
+                batch.append(logging.makeLogRecord({
+                    'name': 'common.log', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Log queue full; dropped %d records' % count,
+                }))
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        target = self.target
+        target.acquire()
+        try:
+            for record in batch:
+                try:
+                    if target.shouldRollover(record):
+                        target.doRollover()
+                    msg = target.format(record)
+                    if isinstance(msg, unicode):
+                        msg = msg.encode('utf-8')
+                    target.stream.write(msg + '\n')
+                except Exception:
+                    target.handleError(record)
+            target.flush() # Once per batch, not once per record
+        finally:
+            target.release()
+
+    def close(self):
+        if self._thread.isAlive():
+            try:
+                self.queue.put(self._stop, timeout=5)
+            except Queue.Full:
+                pass
+            self._thread.join(5)
+        logging.Handler.close(self)
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line. `time` is UTC ISO 8601 with microseconds, so
+    it sorts as a string; merge_logs relies on that.
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data)
+
+class PerProcessFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler on jsonl_filename(<current pid>). If the process
+    forks after this is set up, the child switches to a file of its own.
+    """
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        logging.handlers.RotatingFileHandler.__init__(self, jsonl_filename(self.pid), **kwargs)
+
+    def shouldRollover(self, record):
+        # Called before every write, by emit() and by QueueHandler's writer
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.stream.close()
+            self.baseFilename = os.path.abspath(jsonl_filename(self.pid))
+            self.stream = self._open()
+        return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+
 logger = logging.getLogger('default')
-handler = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=10)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
+if settings.LOG_FORMAT == 'jsonl':
+    prune_jsonl_files(settings.LOG_RETENTION_DAYS)
+    handler = PerProcessFileHandler(maxBytes=100*1024*1024, backupCount=10)
+    handler.setFormatter(JsonFormatter())
+else:
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=10)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+if settings.LOG_ASYNC:
+    handler = QueueHandler(handler, maxsize=settings.LOG_QUEUE_SIZE)
 logger.addHandler(handler)
 
 logger.setLevel(1) # 0 seems to skip DEBUG messages, contrary to the docs
 
-debug =     convert_log_args(logger.debug)
-info =      convert_log_args(logger.info)
-warning =   convert_log_args(logger.warning)
-error =     convert_log_args(logger.error)
-critical =  convert_log_args(logger.critical)
-exception = convert_log_args(logger.exception)
+debug =     convert_log_args(logger.debug, logging.DEBUG)
+info =      convert_log_args(logger.info, logging.INFO)
+warning =   convert_log_args(logger.warning, logging.WARNING)
+error =     convert_log_args(logger.error, logging.ERROR)
+critical =  convert_log_args(logger.critical, logging.CRITICAL)
+exception = convert_log_args(logger.exception, logging.ERROR)
 
@@ -0,0 +1,39 @@
+"""
+Times a disabled common.log call, next to one that joins its args eagerly,
+to show what logging in a hot path costs when its level is off.
+"""
+
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from common import log
+
+def time_calls(f, args, calls):
+    """Seconds per call of f(*args)."""
+    start = time.time()
+    for i in xrange(calls):
+        f(*args)
+    return (time.time() - start) / calls
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--calls', dest='calls', type='int', default=20000,
+            help="How many calls to time each way."),
+    )
+    help = "Times disabled common.log debug() calls against eagerly formatted ones."
+
+    def handle(self, **options):
+        payload = range(200) # Stands in for a model or dict that's costly to stringify
+        eager = lambda *args: log.logger.debug(', '.join(unicode(a) for a in args))
+        old_level = log.logger.level
+        log.logger.setLevel(logging.INFO)
+        try:
+            disabled = time_calls(log.debug, ('request', payload), options['calls'])
+            eager_disabled = time_calls(eager, ('request', payload), options['calls'])
+        finally:
+            log.logger.setLevel(old_level)
+        self.stdout.write('common.log disabled debug(): %.2fus per call (eager join: %.2fus)\n'
+                % (disabled * 1e6, eager_disabled * 1e6))
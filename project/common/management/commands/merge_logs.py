@@ -0,0 +1,127 @@
+"""
+Merges the per-process JSON-lines logs (LOG_FORMAT = 'jsonl') into one
+stream, ordered by time.
+
+Files are read line by line and merged with a heap, so memory use doesn't
+depend on how big the logs are. Each file is assumed to be in time order
+already, which holds for a single process's log.
+
+Files last written before --since are skipped without being opened. If
+more than MAX_OPEN_FILES are left, they're merged in batches into temporary
+files first, so the process never runs out of file descriptors.
+"""
+
+import datetime
+import glob
+import heapq
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+def read_records(path, min_level, since, until):
+    """Yields (time, line) for the records in `path` that pass the filters."""
+    for line in open(path):
+        try:
+            record = json.loads(line)
+            record_time = record['time']
+        except (ValueError, KeyError, TypeError):
+            continue # Partly written line, e.g. from a crash
+        if since and record_time < since:
+            continue
+        if until and record_time >= until:
+            break
+        if logging.getLevelName(record.get('level')) < min_level:
+            continue
+        yield record_time, line
+
+def _tagged(i, records):
+    # The file's index breaks ties, so lines themselves are never compared
+    for record_time, line in records:
+        yield record_time, i, line
+
+def _normalize_time(value):
+    # Records use "2011-10-03T12:00:00.000000Z"; let people type "2011-10-03 12:00"
+    return value and value.replace(' ', 'T')
+
+def _file_time(path):
+    """When `path` was last written, in the same format as its records' times."""
+    return datetime.datetime.utcfromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+MAX_OPEN_FILES = 100
+
+def merge_records(paths, min_level, since, until):
+    """Yields (time, file index, line) for the records in `paths`, in time order."""
+    streams = []
+    for i, path in enumerate(paths):
+        streams.append(_tagged(i, read_records(path, min_level, since, until)))
+    return heapq.merge(*streams)
+
+def merge_in_batches(paths, min_level, since, until, temp_dir):
+    """
+    Merges `paths` MAX_OPEN_FILES at a time into files in temp_dir, until
+    there are few enough left to merge at once. Returns the paths to merge.
+    """
+    while len(paths) > MAX_OPEN_FILES:
+        merged = []
+        for start in range(0, len(paths), MAX_OPEN_FILES):
+            fd, out_path = tempfile.mkstemp(suffix='.jsonl', dir=temp_dir)
+            out = os.fdopen(fd, 'w')
+            try:
+                for record_time, i, line in merge_records(paths[start:start + MAX_OPEN_FILES], min_level, since, until):
+                    out.write(line if line.endswith('\n') else line + '\n')
+            finally:
+                out.close()
+            merged.append(out_path)
+        paths = merged
+    return paths
+
+class Command(BaseCommand):
+    args = '[<log file> ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--level', dest='level', default='DEBUG',
+            help="Only show records at this level or above."),
+        make_option('--since', dest='since', default=None,
+            help="Only show records at or after this UTC time, e.g. '2011-10-03 12:00'."),
+        make_option('--until', dest='until', default=None,
+            help="Only show records before this UTC time."),
+        make_option('--text', action='store_true', dest='text', default=False,
+            help="Print readable lines instead of JSON."),
+    )
+    help = "Merges per-process JSON-lines logs (default: all in LOG_DIRECTORY) in time order."
+
+    def handle(self, *paths, **options):
+        min_level = logging.getLevelName(options['level'].upper())
+        if not isinstance(min_level, int):
+            raise CommandError("Unknown level '%s'" % options['level'])
+        since = _normalize_time(options['since'])
+        until = _normalize_time(options['until'])
+        if not paths:
+            paths = sorted(glob.glob(os.path.join(settings.LOG_DIRECTORY, '*.jsonl*')))
+        if since:
+            # Every record in a file was written by its mtime
+            paths = [path for path in paths if _file_time(path) >= since]
+
+        temp_dir = tempfile.mkdtemp(prefix='merge_logs')
+        try:
+            paths = merge_in_batches(paths, min_level, since, until, temp_dir)
+            self.write(merge_records(paths, min_level, since, until), options['text'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def write(self, records, text):
+        out = sys.stdout
+        for record_time, i, line in records:
+            if text:
+                record = json.loads(line)
+                out.write((u'%s %s [%s] %s\n' % (record_time, record['level'], record['pid'], record['message'])).encode('utf-8'))
+                if record.get('exc'):
+                    out.write(record['exc'].encode('utf-8') + '\n')
+            else:
+                out.write(line)
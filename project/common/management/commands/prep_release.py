@@ -0,0 +1,181 @@
+"""
+Runs the template, database and static steps of a deploy in one Django
+process.
+
+Each database and static step's inputs are hashed, and the hashes are saved
+in the release dir. A step is skipped when its hash matches the one saved by
+the previous release (`--previous`), so a code-only deploy doesn't migrate
+or copy static files again. The templates step always runs, and fails the
+deploy if any template doesn't compile.
+"""
+
+import hashlib
+import json
+import os
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.importlib import import_module
+
+from common.static import carry_forward, collect_into_store, link_tree
+from common.template_cache import compile_templates
+from root_dir import root_dir
+
+HASHES_FILENAME = '.prep_hashes.json'
+TIMINGS_FILENAME = 'timings.json' # Coupled w/fabfile.py, which adds the other deploy phases
+# templates first: a syntax error shouldn't leave a migrated database behind
+STEPS = ['templates', 'syncdb', 'migrate', 'loaddata', 'collectstatic']
+
+def _hash_path(digest, label, path):
+    """Feeds the names and contents of the files under `path` into `digest`."""
+    if os.path.isfile(path):
+        digest.update('%s\0%s\0' % (label, os.path.basename(path)))
+        digest.update(open(path, 'rb').read())
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(('.pyc', '.pyo')):
+                continue
+            full_path = os.path.join(dirpath, name)
+            digest.update('%s\0%s\0' % (label, os.path.relpath(full_path, path)))
+            digest.update(open(full_path, 'rb').read())
+
+def _app_dirs():
+    for app in settings.INSTALLED_APPS:
+        yield app, os.path.dirname(import_module(app).__file__)
+
+def _database_inputs():
+    yield 'INSTALLED_APPS', None
+    for app, app_dir in _app_dirs():
+        for name in ['models.py', 'models', 'migrations']:
+            yield app, os.path.join(app_dir, name)
+
+def _fixture_inputs():
+    for app, app_dir in _app_dirs():
+        yield app, os.path.join(app_dir, 'fixtures')
+    for fixture_dir in getattr(settings, 'FIXTURE_DIRS', ()):
+        yield 'FIXTURE_DIRS', fixture_dir
+
+def _static_inputs():
+    for app, app_dir in _app_dirs():
+        yield app, os.path.join(app_dir, 'static')
+    for static_dir in settings.STATICFILES_DIRS:
+        if isinstance(static_dir, (list, tuple)): # (prefix, path)
+            static_dir = static_dir[1]
+        yield 'STATICFILES_DIRS', static_dir
+
+def compute_hashes():
+    """Returns a dict of step => hash of everything that step depends on."""
+    inputs = {
+        'syncdb': list(_database_inputs()),
+        'migrate': list(_database_inputs()),
+        # initial_data may need reloading after a schema change
+        'loaddata': list(_database_inputs()) + list(_fixture_inputs()),
+        'collectstatic': list(_static_inputs()),
+    }
+    hashes = {}
+    for step, paths in inputs.items():
+        digest = hashlib.md5(step)
+        for label, path in paths:
+            if path is None: # Hash the setting itself
+                digest.update('%s\0%r\0' % (label, getattr(settings, label)))
+            elif os.path.exists(path):
+                _hash_path(digest, label, path)
+        hashes[step] = digest.hexdigest()
+    return hashes
+
+def record_timings(release_dir, phases):
+    """Appends `phases` ({'phase': ..., 'seconds': ...} dicts) to the release's timings."""
+    path = os.path.join(release_dir, TIMINGS_FILENAME)
+    try:
+        record = json.load(open(path))
+    except (IOError, ValueError):
+        record = {'release': os.path.basename(release_dir), 'phases': []}
+    record['phases'].extend(phases)
+    json.dump(record, open(path, 'w'), indent=2)
+
+def load_hashes(release_dir):
+    try:
+        return json.load(open(os.path.join(release_dir, HASHES_FILENAME)))
+    except (IOError, ValueError):
+        return {}
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--previous', dest='previous', default=None,
+            help="Release dir (or symlink to it) to compare against."),
+        make_option('--steps', dest='steps', default=','.join(STEPS),
+            help="Comma-separated steps to consider. Default: %s" % ','.join(STEPS)),
+        make_option('--static-store', dest='static_store', default=None,
+            help="Collect static files as hardlinks into this content-addressed store."),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help="Run every step, even if its inputs are unchanged."),
+    )
+    help = "Checks templates, then runs syncdb, migrate, loaddata and collectstatic, skipping unchanged steps."
+
+    def handle(self, *args, **options):
+        steps = [s for s in options['steps'].split(',') if s]
+        for step in steps:
+            if step not in STEPS:
+                raise CommandError("Unknown step '%s'" % step)
+
+        release_dir = os.path.realpath(root_dir('..'))
+        previous_dir = options['previous'] and os.path.realpath(options['previous'])
+        if previous_dir == release_dir:
+            previous_dir = None
+        previous_hashes = {}
+        if previous_dir and not options['force']:
+            previous_hashes = load_hashes(previous_dir)
+
+        hashes = compute_hashes()
+        done = {}
+        timings = []
+        for step in STEPS:
+            if step not in steps:
+                continue
+            if step in hashes: # 'templates' isn't, so it always runs
+                done[step] = hashes[step]
+            unchanged = step in hashes and hashes[step] == previous_hashes.get(step)
+            start = time.time()
+            self.run_step(step, unchanged, previous_dir, release_dir, options)
+            timings.append({
+                'phase': 'manage.py %s' % step,
+                'seconds': round(time.time() - start, 3),
+                'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+
+        # Only recorded once everything succeeded, so a failed step reruns next time
+        json.dump(done, open(os.path.join(release_dir, HASHES_FILENAME), 'w'), indent=2)
+        record_timings(release_dir, timings)
+
+    def run_step(self, step, unchanged, previous_dir, release_dir, options):
+        verbosity = int(options.get('verbosity', 1))
+        previous_static = previous_dir and os.path.join(previous_dir, os.path.relpath(settings.STATIC_ROOT, release_dir))
+        if unchanged and step == 'collectstatic':
+            if os.path.isdir(previous_static) and not os.path.exists(settings.STATIC_ROOT):
+                self.stdout.write("collectstatic: unchanged, linking files from %s\n" % previous_static)
+                link_tree(previous_static, settings.STATIC_ROOT)
+                return
+        elif unchanged:
+            self.stdout.write("%s: unchanged, skipping\n" % step)
+            return
+        self.stdout.write("%s: running\n" % step)
+        if step == 'templates':
+            errors = compile_templates()
+            if errors:
+                raise CommandError("Templates failed to compile:\n" +
+                    '\n'.join('  %s: %s' % (name, e) for name, e in errors))
+        elif step == 'loaddata':
+            call_command('loaddata', 'initial_data', verbosity=verbosity)
+        elif step == 'collectstatic' and options['static_store']:
+            manifest = collect_into_store(settings.STATIC_ROOT, options['static_store'])
+            self.stdout.write("%d static files linked from %s\n" % (len(manifest), options['static_store']))
+            if previous_static and os.path.isdir(previous_static):
+                count = carry_forward(previous_static, settings.STATIC_ROOT)
+                self.stdout.write("%d hashed files kept from the previous release\n" % count)
+        else:
+            call_command(step, interactive=False, verbosity=verbosity)
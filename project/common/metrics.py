@@ -0,0 +1,115 @@
+"""
+Per-request counters for common.middleware.PerformanceMiddleware: SQL
+queries and time, cache hits and misses, and template render time.
+
+Each thread has its own, from start() to stop(). Outside of that, e.g. in
+management commands, nothing is counted.
+"""
+import threading
+import time
+
+from django.db import connections
+from django.template.base import Template
+
+_local = threading.local()
+
+class RequestMetrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.view = None
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_seconds = 0.0
+        self.rendering = False
+
+def current():
+    """This thread's RequestMetrics, or None outside a request."""
+    return getattr(_local, 'metrics', None)
+
+def start():
+    _local.metrics = metrics = RequestMetrics()
+    for conn in connections.all():
+        # Attributes on the wrapper are per thread, so other threads' cursors
+        # are left alone
+        conn.cursor = _timed_cursor(conn)
+    return metrics
+
+def stop():
+    """Ends counting for this thread and returns what was counted."""
+    metrics = current()
+    _local.metrics = None
+    for conn in connections.all():
+        if 'cursor' in conn.__dict__:
+            del conn.cursor
+    return metrics
+
+def count_cache(hits, misses):
+    """For cache backends; see common.cache.TwoTierCache."""
+    metrics = current()
+    if metrics is not None:
+        metrics.cache_hits += hits
+        metrics.cache_misses += misses
+
+class TimedCursor(object):
+    """Wraps a connection's cursor, adding each query to the current RequestMetrics."""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self._count(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self._count(time.time() - start)
+
+    def _count(self, seconds):
+        metrics = current()
+        if metrics is not None:
+            metrics.sql_count += 1
+            metrics.sql_seconds += seconds
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def _timed_cursor(conn):
+    cursor = type(conn).cursor
+    def timed_cursor():
+        return TimedCursor(cursor(conn))
+    return timed_cursor
+
+_original_render = None
+
+def instrument_templates():
+    """
+    Times Template.render from now on. Only the outermost render in a
+    request is timed, so included templates aren't counted twice. Like
+    django.test.utils.setup_test_environment, this patches Template itself.
+    """
+    global _original_render
+    if _original_render is not None:
+        return
+    _original_render = Template.render
+    def render(self, context):
+        metrics = current()
+        if metrics is None or metrics.rendering:
+            return _original_render(self, context)
+        metrics.rendering = True
+        start = time.time()
+        try:
+            return _original_render(self, context)
+        finally:
+            metrics.template_seconds += time.time() - start
+            metrics.rendering = False
+    Template.render = render
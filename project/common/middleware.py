@@ -0,0 +1,96 @@
+"""
+PerformanceMiddleware measures what each request costs: wall time, SQL
+queries and time, cache hits and misses, and template render time (see
+common.metrics).
+
+- With settings.SERVER_TIMING, they're sent in a Server-Timing header,
+  which browsers' dev tools show next to the request.
+- PERFORMANCE_LOG_RATE of requests are written to common.log.
+- PROFILE_RATE of requests, and any with an X-Profile header equal to
+  PROFILE_TOKEN, run under cProfile. The stats are dumped to
+  LOG_DIRECTORY/profiles/<path>/, for pstats.
+"""
+import cProfile
+import json
+import os
+import random
+import re
+import time
+
+from django.conf import settings
+
+from common import log, metrics
+
+class PerformanceMiddleware(object):
+    """Goes first in MIDDLEWARE_CLASSES, so the other middleware is measured too."""
+    def __init__(self):
+        metrics.instrument_templates()
+
+    def process_request(self, request):
+        metrics.start()
+        if self.should_profile(request):
+            request._profiler = cProfile.Profile()
+            request._profiler.enable()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        current = metrics.current()
+        if current is not None:
+            current.view = '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', type(view_func).__name__))
+
+    def process_response(self, request, response):
+        profiler = getattr(request, '_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        counted = metrics.stop()
+        if counted is None:
+            return response # process_request didn't run, e.g. an earlier middleware answered
+        seconds = time.time() - counted.started
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = server_timing(counted, seconds)
+        if random.random() < settings.PERFORMANCE_LOG_RATE:
+            log.info('request metrics: %s' % json.dumps(summary(request, response, counted, seconds)))
+        if profiler is not None:
+            dump_profile(profiler, request, seconds)
+        return response
+
+    def should_profile(self, request):
+        if settings.PROFILE_TOKEN and request.META.get('HTTP_X_PROFILE') == settings.PROFILE_TOKEN:
+            return True
+        return random.random() < settings.PROFILE_RATE
+
+def server_timing(counted, seconds):
+    return ', '.join([
+        'total;dur=%.1f' % (seconds * 1000),
+        'sql;dur=%.1f;desc="%d queries"' % (counted.sql_seconds * 1000, counted.sql_count),
+        'cache;desc="%d hits, %d misses"' % (counted.cache_hits, counted.cache_misses),
+        'templates;dur=%.1f' % (counted.template_seconds * 1000),
+    ])
+
+def summary(request, response, counted, seconds):
+    return {
+        'method': request.method,
+        'path': request.path,
+        'view': counted.view,
+        'status': response.status_code,
+        'ms': round(seconds * 1000, 1),
+        'sql_count': counted.sql_count,
+        'sql_ms': round(counted.sql_seconds * 1000, 1),
+        'cache_hits': counted.cache_hits,
+        'cache_misses': counted.cache_misses,
+        'template_ms': round(counted.template_seconds * 1000, 1),
+    }
+
+def profile_dir(path):
+    """Where profiles of requests for `path` go; one dir per URL."""
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', path.strip('/'))[:100] or '_root'
+    return os.path.join(settings.LOG_DIRECTORY, 'profiles', name)
+
+def dump_profile(profiler, request, seconds):
+    directory = profile_dir(request.path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory): # Otherwise another process just made it
+            raise
+    filename = '%s_%d_%dms.prof' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), seconds * 1000)
+    profiler.dump_stats(os.path.join(directory, filename))
@@ -0,0 +1,147 @@
+"""Helpers for handling collected static files."""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+
+def link_tree(src, dst):
+    """
+    Recreates the directory tree at `src` under `dst`, hardlinking the files.
+
+    The copy costs no file data, so it is only safe if nothing writes to
+    the files in place afterwards. Symlinks are recreated as symlinks.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            elif name in filenames:
+                os.link(path, target)
+
+MANIFEST_FILENAME = 'staticfiles.json'
+DEFAULT_IGNORE_PATTERNS = ['CVS', '.*', '*~']
+
+def hash_file(path):
+    digest = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def hashed_name(name, file_hash):
+    """css/style.css => css/style.<first 12 chars of hash>.css"""
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, file_hash[:12], ext)
+
+def _replace_with_link(source, target):
+    """Hardlinks `source` at `target`, atomically replacing whatever is there."""
+    target_dir = os.path.dirname(target)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    tmp = '%s.tmp%d' % (target, os.getpid())
+    os.link(source, tmp)
+    os.rename(tmp, target)
+
+def store_file(source, store_dir):
+    """
+    Adds the file at `source` to the content-addressed store, unless its
+    content is already there, and returns its (hash, path in the store).
+    """
+    file_hash = hash_file(source)
+    stored = os.path.join(store_dir, file_hash[:2], file_hash)
+    if not os.path.exists(stored):
+        if not os.path.isdir(os.path.dirname(stored)):
+            try:
+                os.makedirs(os.path.dirname(stored))
+            except OSError, e:
+                if e.errno != errno.EEXIST: # Another deploy made it first
+                    raise
+        tmp = '%s.tmp%d' % (stored, os.getpid())
+        shutil.copyfile(source, tmp)
+        os.chmod(tmp, 0444) # Shared by every release; nothing may write to it
+        os.rename(tmp, stored)
+    return file_hash, stored
+
+def collect_into_store(static_root, store_dir, ignore_patterns=None):
+    """
+    Incremental collectstatic: gathers files from the staticfiles finders
+    into `static_root` as hardlinks into `store_dir`.
+
+    Only content the store hasn't seen before is copied; everything else
+    costs a hash and a link. Each file is also linked under its hashed
+    name, which can be cached forever, and a manifest mapping names to
+    hashed names is written to `static_root`. Returns the manifest.
+    """
+    from django.contrib.staticfiles import finders
+    if ignore_patterns is None:
+        ignore_patterns = DEFAULT_IGNORE_PATTERNS
+    manifest = {}
+    for finder in finders.get_finders():
+        for path, storage in finder.list(ignore_patterns):
+            # Prefix the relative path if the source storage contains it
+            if getattr(storage, 'prefix', None):
+                prefixed_path = os.path.join(storage.prefix, path)
+            else:
+                prefixed_path = path
+            if prefixed_path in manifest: # First finder wins, as in collectstatic
+                continue
+            file_hash, stored = store_file(storage.path(path), store_dir)
+            manifest[prefixed_path] = hashed_name(prefixed_path, file_hash)
+            _replace_with_link(stored, os.path.join(static_root, prefixed_path))
+            _replace_with_link(stored, os.path.join(static_root, manifest[prefixed_path]))
+    # Precompressed siblings (see server/processor) follow their file's hashed
+    # name, so nginx's gzip_static finds them under hashed URLs too.
+    for name in manifest.keys():
+        base = name[:-len('.gz')]
+        if name.endswith('.gz') and base in manifest:
+            _replace_with_link(os.path.join(static_root, name),
+                               os.path.join(static_root, manifest[base] + '.gz'))
+    manifest_file = open(os.path.join(static_root, MANIFEST_FILENAME), 'w')
+    try:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    finally:
+        manifest_file.close()
+    return manifest
+
+def load_manifest(static_root):
+    try:
+        return json.load(open(os.path.join(static_root, MANIFEST_FILENAME)))
+    except (IOError, ValueError):
+        return {}
+
+def carry_forward(previous_root, static_root):
+    """
+    Links the previous release's hashed files into `static_root` too, so
+    pages rendered by the old release (old processes finishing up, cached
+    copies) keep working once this one is live. Goes one release back.
+    Returns how many files were linked.
+    """
+    count = 0
+    for hashed in load_manifest(previous_root).values():
+        for name in (hashed, hashed + '.gz'):
+            source = os.path.join(previous_root, name)
+            target = os.path.join(static_root, name)
+            if os.path.exists(source) and not os.path.exists(target):
+                _replace_with_link(source, target)
+                count += 1
+    return count
+
+_manifests = {}
+
+def get_hashed_name(name):
+    """Looks up `name` in STATIC_ROOT's manifest. Falls back to `name` itself."""
+    from django.conf import settings
+    manifest = _manifests.get(settings.STATIC_ROOT)
+    if manifest is None:
+        manifest = _manifests[settings.STATIC_ROOT] = load_manifest(settings.STATIC_ROOT)
+    return manifest.get(name, name)
@@ -0,0 +1,57 @@
+"""
+Finding, compiling and warming the project's templates. With
+settings.CACHED_TEMPLATES, compiled templates live for the life of the
+process, so each release starts with a fresh cache.
+"""
+import os
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+from django.utils.importlib import import_module
+
+from root_dir import root_dir
+
+TEMPLATE_EXTENSIONS = ('.html', '.txt', '.xml')
+
+def template_dirs():
+    """TEMPLATE_DIRS plus the templates dirs of the project's own apps."""
+    dirs = list(settings.TEMPLATE_DIRS)
+    project_dir = os.path.realpath(root_dir())
+    for app in settings.INSTALLED_APPS:
+        app_dir = os.path.realpath(os.path.dirname(import_module(app).__file__))
+        if app_dir.startswith(project_dir + os.sep):
+            dirs.append(os.path.join(app_dir, 'templates'))
+    return dirs
+
+def find_templates():
+    """Yields the names, as passed to get_template, of all the project's templates."""
+    seen = set()
+    for template_dir in template_dirs():
+        for dirpath, dirnames, filenames in os.walk(template_dir):
+            for filename in sorted(filenames):
+                if not filename.endswith(TEMPLATE_EXTENSIONS):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename), template_dir)
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+
+def compile_templates():
+    """
+    Compiles every template, which also puts it in the cached loader's
+    cache if that's in use. Returns a list of (name, error) for the ones
+    that failed.
+    """
+    errors = []
+    for name in find_templates():
+        try:
+            get_template(name)
+        except (TemplateSyntaxError, TemplateDoesNotExist), e:
+            errors.append((name, e))
+    return errors
+
+def warm_template_cache():
+    """For wsgi.py: compiles everything up front if templates are cached."""
+    if getattr(settings, 'CACHED_TEMPLATES', False):
+        compile_templates()
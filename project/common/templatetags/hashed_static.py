@@ -0,0 +1,15 @@
+from django import template
+from django.conf import settings
+
+from common.static import get_hashed_name
+
+register = template.Library()
+
+@register.simple_tag
+def hashed_static(name):
+    """
+    URL of a static file under its content-hashed name, if it has one.
+
+    Usage: {% hashed_static "css/global.css" %}
+    """
+    return settings.STATIC_URL + get_hashed_name(name)
@@ -45,3 +45,62 @@ class RequestFactory(Client):
                 raise Exception("Couldn't create request mock object - "
                                 "request middleware returned a response")
         return request
+
+
+import logging, logging.handlers, os, re, shutil, tempfile
+from django.test import TestCase
+
+class CountedStr(object):
+    """Counts how often it's turned into a string."""
+    def __init__(self):
+        self.count = 0
+
+    def __unicode__(self):
+        self.count += 1
+        return u'counted'
+
+class LogTest(TestCase):
+    """For timings, see the benchmark_log command."""
+
+    def test_disabled_call_formats_nothing(self):
+        from common import log
+        arg = CountedStr()
+        old_level = log.logger.level
+        log.logger.setLevel(logging.INFO)
+        try:
+            log.debug('request', arg)
+            self.assertEqual(arg.count, 0)
+            log.info('request', arg)
+            self.assertTrue(arg.count > 0) # Once per handler that writes it
+        finally:
+            log.logger.setLevel(old_level)
+
+    def test_lazy_message(self):
+        from common.log import LazyMessage
+        self.assertEqual(unicode(LazyMessage(('a', 1, u'\xe9'))), u'a, 1, \xe9')
+        self.assertEqual(str(LazyMessage(('a', 1, u'\xe9'))), 'a, 1, \xc3\xa9')
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        from common.log import QueueHandler
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.log')
+            target = logging.handlers.RotatingFileHandler(path)
+            handler = QueueHandler(target, maxsize=2, batch_size=1)
+            target.acquire() # Stalls the writer, as a slow disk would
+            try:
+                for i in range(10):
+                    handler.handle(logging.makeLogRecord({'msg': 'record %d' % i}))
+            finally:
+                target.release()
+            # At most 2 queued and 1 taken by the writer
+            self.assertTrue(handler.dropped >= 7)
+            handler.close()
+            lines = open(path).read().splitlines()
+            written = [line for line in lines if line.startswith('record')]
+            reported = [int(n) for n in re.findall(r'dropped (\d+) records', '\n'.join(lines))]
+            self.assertEqual(len(written), 10 - handler.dropped)
+            self.assertEqual(sum(reported), handler.dropped)
+            target.close()
+        finally:
+            shutil.rmtree(directory)
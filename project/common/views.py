@@ -2,23 +2,212 @@
 
 from django.http import HttpResponse
 
+# Streamed responses are sent in chunks of roughly this many bytes
+JSON_STREAM_CHUNK_SIZE = 16 * 1024
+
 def json_response(obj):
     """Makes JSON HttpResponse out of obj."""
     from django.http import HttpResponse
     from django.utils import simplejson
     return HttpResponse(simplejson.dumps(obj), mimetype='application/javascript')
 
-def json(f):
-    """Decorator for views that return JSON."""
+def get_json_dumps():
+    """
+    Returns the fastest dumps() available: ujson's if it's installed,
+    otherwise Django's simplejson, which already prefers a C-accelerated
+    simplejson or json module.
+    """
+    try:
+        import ujson
+        return ujson.dumps
+    except ImportError:
+        from django.utils import simplejson
+        return simplejson.dumps
+
+def iter_json(obj, chunk_size=JSON_STREAM_CHUNK_SIZE):
+    """
+    Yields the JSON for obj in chunks. Lists, tuples, generators and other
+    iterators are encoded one item at a time, as a JSON array, so they never
+    have to be in memory all at once. Anything else is encoded in one go.
+    """
+    dumps = get_json_dumps()
+    if isinstance(obj, (dict, basestring)) or not hasattr(obj, '__iter__'):
+        yield dumps(obj)
+        return
+    chunk = []
+    size = 0
+    separator = '['
+    for item in obj:
+        encoded = dumps(item)
+        chunk.append(separator)
+        chunk.append(encoded)
+        separator = ','
+        size += len(encoded) + 1
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if separator == '[': # Nothing was written
+        chunk.append('[')
+    chunk.append(']')
+    yield ''.join(chunk)
+
+def iter_gzip(chunks):
+    """Gzips a stream of strings as it goes."""
+    import zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_ending_request(chunks):
+    """
+    Passes chunks through, then cleans up database connections; see
+    common.db.end_request. Django sends request_finished before the body is
+    sent, so queries made while it's encoded would otherwise be left open.
+    """
+    from common import db
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        db.end_request()
+
+def streaming_json_response(obj, request=None, gzip=False):
+    """
+    Makes a streaming JSON HttpResponse out of obj; see iter_json. With
+    gzip, the body is compressed on the fly if request accepts it.
+
+    The body is encoded while it's being sent, so an error half way through
+    can't turn into a 500 anymore: the client gets a truncated response.
+    """
+    content = iter_ending_request(iter_json(obj))
+    compress = gzip and request and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if compress:
+        content = iter_gzip(content)
+    # Passed to the constructor: setting .content would join the iterator
+    response = HttpResponse(content, mimetype='application/json')
+    if gzip:
+        response['Vary'] = 'Accept-Encoding'
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+def json(f=None, stream=False, gzip=False):
+    """
+    Decorator for views that return JSON.
+
+    @json(stream=True) streams the result instead of building the whole
+    string first, so a view can return e.g.
+    common.db.chunked_iterator(Model.objects.values('id', 'name')) and
+    have it fetched and encoded a chunk at a time. Add gzip=True to
+    compress it on the fly as well.
+    """
+    if f is None:
+        return lambda f: json(f, stream=stream, gzip=gzip)
     from functools import wraps
     @wraps(f)
     def json_view(*args, **kwargs):
         result = f(*args, **kwargs)
         if isinstance(result, HttpResponse):
             return result
+        if stream:
+            request = args[0] if args else None
+            return streaming_json_response(result, request, gzip=gzip)
         return json_response(result)
     return json_view
 
+def cache_key_parts(request, vary_on):
+    """The parts of the request a cached view varies on; see cache_view."""
+    parts = []
+    for name in vary_on:
+        if callable(name):
+            parts.append(name(request))
+        elif name == 'path':
+            parts.append(request.path)
+        elif name == 'query':
+            parts.append(request.GET.urlencode())
+        elif name == 'user':
+            user = getattr(request, 'user', None)
+            parts.append(user.pk if user and user.is_authenticated() else 'anon')
+        else:
+            raise ValueError('cache_view: unknown vary_on %r' % (name,))
+    return parts
+
+def cache_view(ttl, vary_on=('path', 'query'), stale=0, lock_timeout=30):
+    """
+    Caches the responses of a view, e.g. one wrapped in @json or returning
+    req_render_to_response, for `ttl` seconds in the default cache.
+
+    `vary_on` names what the cache key is built from: 'path', 'query',
+    'user', or functions that take the request and return a string. Unless
+    'user' is in there, only anonymous requests are cached.
+
+    With `stale`, an expired response is kept for that many more seconds.
+    The first request to see it recomputes it, holding a lock so no other
+    worker does the same; meanwhile everyone else gets the stale copy. The
+    lock is then kept for `ttl`, since other processes can go on seeing the
+    stale copy in common.cache.TwoTierCache's local tier.
+
+    Only 200 responses to GET and HEAD requests are cached, and not ones
+    that streamed or used a CSRF token. Keys include settings.RELEASE_NAME,
+    since responses link to the release's hashed static files.
+    """
+    import hashlib, time
+    from functools import wraps
+    from django.conf import settings
+    from django.core.cache import cache
+
+    def decorator(f):
+        name = '%s.%s' % (f.__module__, f.__name__)
+        cache_user = 'user' in vary_on
+        @wraps(f)
+        def cached_view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return f(request, *args, **kwargs)
+            if not cache_user:
+                user = getattr(request, 'user', None)
+                if user and user.is_authenticated():
+                    return f(request, *args, **kwargs)
+            parts = cache_key_parts(request, vary_on)
+            digest = hashlib.md5(repr([settings.RELEASE_NAME] + parts)).hexdigest()
+            key = '%sview:%s:%s' % (settings.CACHE_MIDDLEWARE_KEY_PREFIX, name, digest)
+            lock_key = key + ':lock'
+
+            locked = False
+            entry = cache.get(key)
+            if entry is not None:
+                fresh_until, status, content, headers = entry
+                if time.time() >= fresh_until:
+                    locked = cache.add(lock_key, 1, lock_timeout)
+                if not locked:
+                    response = HttpResponse(content, status=status)
+                    for header, value in headers:
+                        response[header] = value
+                    return response
+            # Missing, or stale and we hold the lock: recompute
+            stored = False
+            try:
+                response = f(request, *args, **kwargs)
+                if (response.status_code == 200 and response._is_string
+                        and not request.META.get('CSRF_COOKIE_USED')):
+                    entry = (time.time() + ttl, response.status_code, response.content,
+                             response.items())
+                    cache.set(key, entry, ttl + stale)
+                    stored = True
+            finally:
+                if locked and stored:
+                    # Held until the new copy goes stale rather than deleted:
+                    # other processes may still have the old one in a local tier
+                    cache.set(lock_key, 1, ttl)
+                elif locked:
+                    cache.delete(lock_key) # So someone else can try
+            return response
+        return cached_view
+    return decorator
+
 def req_render_to_response(request, template, context=None):
     """render_to_response with request context"""
     from django.shortcuts import render_to_response
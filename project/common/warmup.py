@@ -0,0 +1,16 @@
+"""
+Does the work Django otherwise leaves to a process's first request, so
+wsgi.py can do it when the process starts instead.
+"""
+from django.core.urlresolvers import get_resolver
+from django.db.models.loading import get_models
+
+from common.template_cache import warm_template_cache
+
+def warm_up(handler):
+    """Loads models, the URLconf (and with it admin.autodiscover), `handler`'s middleware and templates."""
+    get_models()
+    get_resolver(None).url_patterns
+    if handler._request_middleware is None:
+        handler.load_middleware()
+    warm_template_cache()
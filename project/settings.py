@@ -1,3 +1,5 @@
+import os
+
 from root_dir import root_dir
 
 PROJECT_NAME = 'project'
@@ -22,8 +24,19 @@ DATABASES = {
         'PORT': '',
     }
 }
-
-TIME_ZONE = 'UTC'
+# Where to connect to, if not Postgres's local socket: stagesettings.py
+# points these at pgbouncer when the stage uses it, or at a separate
+# database host.
+DB_HOST = ''
+DB_PORT = ''
+# common.db: keep connections open across requests, checking ones that have
+# been idle for DB_HEALTH_CHECK_INTERVAL seconds, and reconnecting every
+# DB_CONNECTION_MAX_AGE seconds.
+PERSISTENT_DB_CONNECTIONS = False
+DB_HEALTH_CHECK_INTERVAL = 30
+DB_CONNECTION_MAX_AGE = 3600
+
+TIME_ZONE = 'UTC' # Coupled w/timezone in server/database/postgresql.conf
 
 UZE_TZ = True
 
@@ -68,6 +81,10 @@ TEMPLATE_LOADERS = (
     'django.template.loaders.app_directories.Loader',
 #     'django.template.loaders.eggs.Loader',
 )
+# Keep compiled templates in memory for the life of the process, instead of
+# reading and parsing them on every render. Deploys restart the processes.
+# Set per stage in stagesettings.py.
+CACHED_TEMPLATES = False
 
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
@@ -95,6 +112,7 @@ INSTALLED_APPS = (
     # 'django.contrib.admindocs',
     'south',
     'registration',
+    'common',
     'main'
 )
 
@@ -142,15 +160,48 @@ LOGGING = {
     }
 }
 
+# common.log: write log records from a background thread instead of the
+# request thread. At most LOG_QUEUE_SIZE records wait; beyond that they're dropped.
+LOG_ASYNC = False
+LOG_QUEUE_SIZE = 10000
+# 'text': one django_<uid>.log shared by the user's processes.
+# 'jsonl': JSON lines, one file per process; read them with manage.py merge_logs.
+LOG_FORMAT = 'text'
+# 'jsonl' files of processes that have exited are deleted this long after
+# their last write, by the next process to set up logging.
+LOG_RETENTION_DAYS = 7
+
+# common.cache.TwoTierCache is memcached with a small per-process LRU in
+# front; LOCAL_TIMEOUT is how stale a local copy may get.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'BACKEND': 'common.cache.TwoTierCache',
         'LOCATION': '127.0.0.1:11211',
+        'OPTIONS': {
+            'LOCAL_TIMEOUT': 5,
+            'LOCAL_MAX_BYTES': 16*1024*1024,
+        },
     }
 }
 
+# common.middleware.PerformanceMiddleware measures each request: wall time, SQL,
+# cache hits and misses, and template rendering. PERFORMANCE_LOG_RATE of
+# requests are written to common.log. SERVER_TIMING sends the numbers to the
+# browser too, so it's set per stage in stagesettings.py.
+PERFORMANCE_METRICS = True
+PERFORMANCE_LOG_RATE = 0.01
+SERVER_TIMING = False
+# Share of requests run under cProfile, dumped to LOG_DIRECTORY/profiles/.
+# Requests with an "X-Profile: <PROFILE_TOKEN>" header are profiled as well.
+PROFILE_RATE = 0.0
+PROFILE_TOKEN = ''
+
 # Prevent project cache collisions
 CACHE_MIDDLEWARE_KEY_PREFIX = PROJECT_NAME + ':'
+# The release dir's name, e.g. 2011-05-01-12-00-00_<commit> on the servers.
+# Goes in the keys of cached output that differs between releases (see
+# common.views.cache_view), since old and new releases share the cache.
+RELEASE_NAME = os.path.basename(os.path.realpath(root_dir('..')))
 
 try:
     from stagesettings import *
@@ -162,4 +213,13 @@ try:
 except ImportError:
     pass
 
+if DB_HOST:
+    DATABASES['default'].update(HOST=DB_HOST, PORT=DB_PORT)
+
+if PERFORMANCE_METRICS:
+    MIDDLEWARE_CLASSES = ('common.middleware.PerformanceMiddleware',) + MIDDLEWARE_CLASSES
 
+if CACHED_TEMPLATES:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
@@ -3,9 +3,11 @@ from django.conf.urls.defaults import patterns, include, url
 from django.contrib import admin
 from django.views.generic.simple import direct_to_template, redirect_to
 
+from common.db import setup_persistent_connections
 from root_dir import root_dir
 
 admin.autodiscover()
+setup_persistent_connections()
 
 urlpatterns = patterns('main.views',
     (r'^$', 'index'),
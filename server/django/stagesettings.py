@@ -0,0 +1,8 @@
+# Settings for this stage, written by fabfile.configure_django
+CACHED_TEMPLATES = {{ cached_templates }}
+PERSISTENT_DB_CONNECTIONS = {{ persistent_db_connections }}
+SERVER_TIMING = {{ server_timing }}
+{% if database_host %}
+DB_HOST = '{{ database_host }}'
+DB_PORT = '{{ database_port }}'
+{% endif %}
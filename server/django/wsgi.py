@@ -1,10 +1,15 @@
 import os, sys, site
-sys.path.insert(0, '/project/{{ PROJECT_NAME }}/current')
+sys.path.insert(0, '/project/{{ PROJECT_NAME }}/{{ release_link }}')
 # The project root should be on the pythonpath. This lets you drop-in 3rd-party apps.
-sys.path.insert(0, '/project/{{ PROJECT_NAME }}/current/{{ PROJECT_NAME }}')
+sys.path.insert(0, '/project/{{ PROJECT_NAME }}/{{ release_link }}/{{ PROJECT_NAME }}')
 site.addsitedir('/envs/{{ PROJECT_NAME }}/lib/python{{ PYTHON_VERSION_STR }}/site-packages/')
 
 os.environ['DJANGO_SETTINGS_MODULE'] = '{{ PROJECT_NAME }}.settings'
 
 import django.core.handlers.wsgi
 application = django.core.handlers.wsgi.WSGIHandler()
+
+# The vhost imports this file when each daemon process starts (WSGIImportScript),
+# so this happens then, rather than on every process's first request.
+from common.warmup import warm_up
+warm_up(application)